@@ -1,6 +1,48 @@
+"""
+turbopy: python interface to turbospectrum
+
+Submodules and their contents are imported lazily on first use, so that
+e.g. pool workers that only call run_synth do not pay for astropy.
+"""
 from __future__ import absolute_import, division, print_function
+import importlib
 from .version import __version__
 
-from .linelists import get_default_linelist, TSLineList
-from .marcs import interp_atmosphere, load_atmosphere, MARCSModel
-from .synth import run_synth
+_submodules = ["batch", "cost", "fitting", "linelists", "marcs", "parallel", "process", "server", "synth", "utils"]
+
+# public name -> submodule it lives in
+_exports = {
+    "get_default_linelist": "linelists",
+    "TSLineList": "linelists",
+    "interp_atmosphere": "marcs",
+    "load_atmosphere": "marcs",
+    "MARCSModel": "marcs",
+    "run_synth": "synth",
+    "run_synth_windows": "synth",
+    "run_synth_intensities": "synth",
+    "run_synth_adaptive": "synth",
+    "WindowedSpectrum": "synth",
+    "abundance_jacobian": "fitting",
+    "build_abundance_emulator": "fitting",
+    "AbundanceEmulator": "fitting",
+    "TurbospectrumError": "process",
+    "synth_spec": "batch",
+    "plan_batch": "batch",
+    "run_batch": "batch",
+    "dry_run": "batch",
+    "CostModel": "cost",
+}
+
+__all__ = ["__version__"] + _submodules + list(_exports)
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    if name in _exports:
+        value = getattr(importlib.import_module("." + _exports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,289 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import heapq
+import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from . import synth
+from . import parallel
+from . import cost
+from . import linelists
+
+def synth_spec(wmin, wmax, dwl, *args, **kwargs):
+    """
+    Describe one synthesis for a batch, with the same arguments as run_synth.
+    Returns (args, kwargs).
+    """
+    return (wmin, wmax, dwl) + tuple(args), dict(kwargs)
+
+class BatchPlan(object):
+    """
+    Two-level plan for a list of syntheses (see synth_spec).
+
+    babsma_lu only depends on the atmosphere, vt, wavelength grid, geometry and the
+    abundances of elements that affect the continuum (see synth.opacity_key);
+    bsyn_lu depends on everything. Jobs with the same opacity key form a group
+    that shares one babsma_lu run, and each job is then one bsyn_lu run.
+    Jobs whose opacity cannot be shared (e.g. interpolated atmospheres, or a
+    given modelopac) are groups of one that run all of run_synth.
+    """
+    def __init__(self, specs):
+        super(BatchPlan, self).__init__()
+        self.specs = [(tuple(args), dict(kwargs)) for args, kwargs in specs]
+        self.groups = [] # list of (opacity key or None, job indices)
+        keys = {}
+        for ijob, (args, kwargs) in enumerate(self.specs):
+            key = None
+            if kwargs.get("modelopac") is None:
+                key = synth.opacity_key(args[0], args[1], args[2], args[3:],
+                                        kwargs.get("atmosphere"), kwargs.get("vt"),
+                                        kwargs.get("marcsfile", True), kwargs.get("spherical", False))
+            if key is None:
+                self.groups.append((None, [ijob]))
+            elif key in keys:
+                self.groups[keys[key]][1].append(ijob)
+            else:
+                keys[key] = len(self.groups)
+                self.groups.append((key, [ijob]))
+
+    @property
+    def njobs(self):
+        return len(self.specs)
+    @property
+    def nbabsma(self):
+        return len(self.groups)
+    @property
+    def dedup_ratio(self):
+        """ babsma_lu runs without the plan / with the plan """
+        return self.njobs / max(self.nbabsma, 1)
+
+    def report(self):
+        return dict(njobs=self.njobs, nbabsma=self.nbabsma, nbsyn=self.njobs,
+                    dedup_ratio=self.dedup_ratio,
+                    largest_group=max([len(jobs) for key, jobs in self.groups] + [0]))
+
+    def capacities(self):
+        """ Upper limit on the number of wavelength points of each job """
+        # One spare point, in case Turbospectrum rounds the last point differently
+        return [cost.get_npoints(*args[:3]) + 1 for args, kwargs in self.specs]
+
+    def estimate(self, model=None):
+        """
+        Predicted seconds of every babsma_lu run and every job, from a cost.CostModel
+        (default: fitted to the recorded timings). Groups without an opacity key cost
+        nothing here; their babsma_lu is part of the job.
+        Returns (seconds per group, seconds per job).
+        """
+        if model is None:
+            model = cost.CostModel()
+        group_seconds = np.zeros(len(self.groups))
+        job_seconds = np.zeros(self.njobs)
+        nbytes = {}
+        for igroup, (key, jobs) in enumerate(self.groups):
+            for ijob in jobs:
+                args, kwargs = self.specs[ijob]
+                wmin, wmax, dwl = args[:3]
+                npoints = cost.get_npoints(wmin, wmax, dwl)
+                spherical = kwargs.get("spherical", False)
+                linelist, Hlinelist = kwargs.get("linelist"), kwargs.get("Hlinelist")
+                # Estimated from the file sizes, without trimming anything
+                nbytes_key = (id(linelist), Hlinelist, wmin, wmax)
+                if nbytes_key not in nbytes:
+                    if linelist is None:
+                        linelist = linelists.get_default_linelist(wmin, wmax)
+                    nbytes[nbytes_key] = linelist.estimate_bytes(wmin, wmax) + \
+                        linelists.estimate_Hlinelist_bytes(wmin, wmax, Hlinelist)
+                job_seconds[ijob] = model.predict("bsyn_lu", npoints, nbytes[nbytes_key], spherical)
+                babsma_seconds = model.predict("babsma_lu", npoints, 0, spherical)
+                if key is not None and ijob == jobs[0]:
+                    group_seconds[igroup] = babsma_seconds
+                elif key is None and kwargs.get("modelopac") is None:
+                    job_seconds[ijob] += babsma_seconds
+        return group_seconds, job_seconds
+
+    def schedule(self, model=None):
+        """
+        Longest job first. Each task (a babsma_lu run or a job) is ranked by its
+        work: its predicted seconds plus those of the jobs waiting on it. Whenever a
+        worker is free it gets the ready task with the most work, so the big jobs
+        start early instead of running alone at the end of a batch.
+
+        Returns (initial tasks, children, seconds, work): tasks are ("opacity", igroup)
+        or ("job", ijob); the initial tasks are ready from the start; children maps
+        an opacity task to the job tasks that need it; seconds and work map every
+        task to its predicted seconds and work.
+        """
+        group_seconds, job_seconds = self.estimate(model)
+        initial, children, seconds, work = [], {}, {}, {}
+        for igroup, (key, jobs) in enumerate(self.groups):
+            job_tasks = [("job", ijob) for ijob in jobs]
+            for task in job_tasks:
+                seconds[task] = work[task] = float(job_seconds[task[1]])
+            if key is None:
+                initial.extend(job_tasks)
+            else:
+                task = ("opacity", igroup)
+                seconds[task] = float(group_seconds[igroup])
+                work[task] = seconds[task] + float(job_seconds[jobs].sum())
+                children[task] = job_tasks
+                initial.append(task)
+        return initial, children, seconds, work
+
+    def dry_run(self, nproc=None, model=None):
+        """
+        Predict the cost of running the plan on nproc workers without running it.
+        Returns the plan report with wall_time (seconds, simulating the schedule
+        of run), core_hours and serial_time (seconds on one worker).
+        """
+        nproc = parallel.get_nproc(nproc)
+        initial, children, seconds, work = self.schedule(model)
+        total = float(sum(seconds.values()))
+        report = self.report()
+        report.update(nproc=nproc, wall_time=_simulate(initial, children, seconds, work, nproc),
+                      serial_time=total, core_hours=total/3600.)
+        return report
+
+    def run(self, nproc=None, workdir=None, verbose=False, backend="thread", model=None):
+        """
+        Run the plan: each unique babsma_lu once, and the bsyn_lu runs of a group
+        once its opacity is ready, up to nproc at once, longest first (see schedule).
+
+        backend= ("thread") run the jobs in threads; returns a list with the
+                    (wave, norm, flux) of every job in the order of the specs
+                 "process" run the jobs in worker processes, which write their spectra
+                    straight into one shared memory block; returns a parallel.SharedSpectra
+                    with (wave, norm, flux) views for every job in the order of the specs.
+                    Close it (or use it in a with statement) when done with the views.
+        model= (None) cost.CostModel for the schedule; default is fitted to the recorded timings
+        """
+        assert backend in ["thread", "process"], backend
+        initial, children, seconds, work = self.schedule(model)
+        if workdir is None:
+            workdir = tempfile.mkdtemp(dir=os.getcwd()+"/tmp")
+        workdir = os.path.abspath(workdir)
+        nproc = parallel.get_nproc(nproc)
+        if backend == "thread":
+            Executor, shared, results = ThreadPoolExecutor, None, [None]*self.njobs
+            shared_args = (None, None)
+        else:
+            Executor, shared = ProcessPoolExecutor, parallel.SharedSpectra(self.capacities())
+            results = shared
+            shared_args = (shared.name, shared.capacities)
+        ready = _ReadyQueue(work, initial)
+        modelopacs = {} # ijob -> opacity file of its group, once computed
+        running = {}
+        try:
+            with Executor(max_workers=nproc) as pool:
+                # Only nproc tasks at a time, so the pool's queue never decides the order
+                while ready or running:
+                    while ready and len(running) < nproc:
+                        kind, i = task = ready.pop()
+                        if kind == "opacity":
+                            future = pool.submit(_run_opacity, workdir, i,
+                                                 self.specs[self.groups[i][1][0]], verbose)
+                        else:
+                            future = pool.submit(_run_job, workdir, i, self.specs[i],
+                                                 modelopacs.get(i), *shared_args)
+                        running[future] = task
+                    done, pending = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        kind, i = task = running.pop(future)
+                        if kind == "opacity":
+                            # The group's bsyn_lu runs can go now
+                            modelopac = future.result()
+                            for child in children[task]:
+                                modelopacs[child[1]] = modelopac
+                                ready.push(child)
+                        elif shared is None:
+                            results[i] = future.result()
+                        else:
+                            shared.set_length(i, future.result())
+        except BaseException:
+            if shared is not None: shared.close()
+            raise
+        return results
+
+class _ReadyQueue(object):
+    """ Tasks that can start, the one with the most work first """
+    def __init__(self, work, tasks=[]):
+        super(_ReadyQueue, self).__init__()
+        self.work = work
+        self.heap = []
+        self.counter = itertools.count()
+        for task in tasks:
+            self.push(task)
+
+    def push(self, task):
+        heapq.heappush(self.heap, (-self.work[task], next(self.counter), task))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def __len__(self):
+        return len(self.heap)
+
+def _simulate(initial, children, seconds, work, nproc):
+    """ Predicted wall time of running the tasks on nproc workers the way run does """
+    ready = _ReadyQueue(work, initial)
+    running = [] # heap of (end time, order, task)
+    counter = itertools.count()
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < nproc:
+            task = ready.pop()
+            heapq.heappush(running, (now + seconds[task], next(counter), task))
+        now, order, task = heapq.heappop(running)
+        for child in children.get(task, []):
+            ready.push(child)
+    return now
+
+def _run_opacity(workdir, igroup, spec, verbose):
+    """ babsma_lu for a group, using its first job's inputs """
+    args, kwargs = spec
+    kwargs = dict(kwargs, verbose=verbose)
+    return synth._run_shared_babsma(os.path.join(workdir, f"opacity{igroup:05}"), args, kwargs)
+
+def _run_job(workdir, ijob, spec, modelopac, shared_name=None, capacities=None):
+    """
+    run_synth for one job. Returns the spectrum, or if shared_name is given,
+    writes it into that SharedSpectra block and returns its number of points.
+    """
+    args, kwargs = spec
+    kwargs = dict(kwargs)
+    if modelopac is not None:
+        kwargs["modelopac"] = modelopac
+    if kwargs.get("twd") is None:
+        kwargs["twd"] = os.path.join(workdir, f"job{ijob:05}")
+    spectrum = synth.run_synth(*args, **kwargs)
+    if shared_name is None:
+        return spectrum
+    shared = parallel.SharedSpectra.attach(shared_name, capacities)
+    try:
+        return shared.write(ijob, *spectrum)
+    finally:
+        shared.close()
+
+def plan_batch(specs):
+    """ Plan a list of syntheses (see synth_spec and BatchPlan) """
+    return BatchPlan(specs)
+
+def run_batch(specs, nproc=None, workdir=None, verbose=False, backend="thread", model=None):
+    """
+    Run a list of syntheses (see synth_spec), sharing babsma_lu runs where possible,
+    longest jobs first according to model (see BatchPlan.schedule).
+    Returns (results, plan report); see BatchPlan.run for the results and backend.
+    """
+    plan = plan_batch(specs)
+    return plan.run(nproc=nproc, workdir=workdir, verbose=verbose, backend=backend,
+                    model=model), plan.report()
+
+def dry_run(specs, nproc=None, model=None):
+    """
+    Predicted wall time, core hours and plan report of a list of syntheses
+    (see synth_spec) on nproc workers, without running them (see BatchPlan.dry_run).
+    """
+    return plan_batch(specs).dry_run(nproc=nproc, model=model)
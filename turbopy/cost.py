@@ -0,0 +1,152 @@
+"""
+Runtime cost model for Turbospectrum runs.
+
+Every babsma_lu and bsyn_lu run records its wall time and the job features
+(number of wavelength points, size of the linelists in the window, spherical
+or plane-parallel model) in a timings file. CostModel fits
+
+    log(seconds) = c0 + c1 log(npoints) + c2 log(1 + linelist MB) + c3 spherical
+
+per program to those records, pulled towards rough defaults when there are
+few of them, and predicts the cost of runs that have not happened yet.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import tempfile
+import threading
+
+import numpy as np
+
+from .linelists import get_cache_dir
+
+_programs = ["babsma_lu", "bsyn_lu"]
+# Rough coefficients used until there are timings to fit
+_default_coeffs = {
+    "babsma_lu": np.array([np.log(0.02), 0.5, 0.0, 0.7]),
+    "bsyn_lu": np.array([np.log(1e-3), 1.0, 1.0, 0.7]),
+}
+_prior_weight = 1.0 # how many records the defaults are worth
+_max_records = 10000 # most recent records used per program
+_max_timings_bytes = 4*1024**2 # past this the timings file keeps only its newest half (~20000 records)
+_record_lock = threading.Lock()
+record_timings = True # set to False to stop recording timings
+
+def get_timings_file():
+    """ $TURBOPY_TIMINGS if set, else timings.jsonl in the linelist cache dir """
+    return os.getenv("TURBOPY_TIMINGS", os.path.join(get_cache_dir(create=False), "timings.jsonl"))
+
+def linelist_bytes(linelistfilenames):
+    """ Size of the linelist files of a run, which scales with the number of lines """
+    return sum([os.path.getsize(f) for f in linelistfilenames if os.path.exists(f)])
+
+def get_npoints(wmin, wmax, dwl):
+    """
+    Number of wavelength points Turbospectrum produces for [wmin, wmax] with step dwl.
+    The scripts write all three with 3 decimals, so e.g. dwl=0.0124 runs at 0.012.
+    """
+    wmin, wmax, dwl = [float("%.3f" % x) for x in (wmin, wmax, dwl)]
+    assert dwl > 0, f"Step {dwl} is 0 with 3 decimals"
+    return int(np.floor((wmax-wmin)/dwl + 1e-6)) + 1
+
+def get_features(npoints, nbytes, spherical):
+    """ Design matrix rows for the model; arguments can be arrays """
+    npoints, nbytes, spherical = np.broadcast_arrays(np.asarray(npoints, dtype=float),
+                                                     np.asarray(nbytes, dtype=float),
+                                                     np.asarray(spherical, dtype=float))
+    return np.stack([np.ones_like(npoints), np.log(np.maximum(npoints, 1)),
+                     np.log1p(nbytes/1e6), spherical], axis=-1)
+
+def record_timing(program, npoints, nbytes, spherical, seconds, fname=None):
+    """ Append one run to the timings file; a timing that cannot be written is dropped """
+    if not record_timings or seconds is None: return
+    line = json.dumps(dict(program=program, npoints=int(npoints), nbytes=int(nbytes),
+                           spherical=bool(spherical), seconds=float(seconds)))
+    fname = fname or get_timings_file()
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+        with _record_lock:
+            # One short write in append mode, so processes sharing the file do not interleave lines
+            with open(fname, "a") as fp:
+                fp.write(line+"\n")
+            if os.path.getsize(fname) > _max_timings_bytes:
+                _rotate_timings(fname)
+    except OSError:
+        pass
+
+def _rotate_timings(fname):
+    """
+    Keep the newest half of the timings file. Timings that other processes append
+    while this runs can be lost, which only costs a few records.
+    """
+    with open(fname) as fp:
+        lines = fp.readlines()
+    fd, tmpfname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)))
+    with os.fdopen(fd, "w") as fp:
+        fp.writelines(lines[len(lines)//2:])
+    os.replace(tmpfname, fname)
+
+def read_timings(fname=None):
+    """ All recorded runs, as a list of dicts; skips lines that are not complete """
+    fname = fname or get_timings_file()
+    records = []
+    if not os.path.exists(fname): return records
+    with open(fname) as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("program") in _programs and record.get("seconds", 0) > 0:
+                records.append(record)
+    return records
+
+class CostModel(object):
+    """
+    Predicts the wall time of babsma_lu and bsyn_lu runs.
+
+    INPUT ARGUMENTS:
+       records= (None) list of timing records (see read_timings) to fit;
+          None reads the timings file
+    """
+    def __init__(self, records=None):
+        super(CostModel, self).__init__()
+        if records is None:
+            records = read_timings()
+        self.coeffs = {}
+        self.scatter = {}
+        self.nrecords = {}
+        for program in _programs:
+            self.fit(program, [r for r in records if r["program"] == program][-_max_records:])
+
+    def fit(self, program, records):
+        """
+        Ridge fit of the slopes towards the default ones, so a few records (or records
+        that are all plane-parallel) still give a sensible model. The overall scale
+        (c0) is free, since any one record fixes it.
+        """
+        prior = _default_coeffs[program]
+        self.nrecords[program] = len(records)
+        if len(records) == 0:
+            self.coeffs[program] = prior.copy()
+            self.scatter[program] = None
+            return
+        X = get_features([r["npoints"] for r in records], [r["nbytes"] for r in records],
+                         [r["spherical"] for r in records])
+        y = np.log([r["seconds"] for r in records])
+        penalty = _prior_weight*np.diag([0.]+[1.]*(len(prior)-1))
+        A = X.T @ X + penalty
+        b = X.T @ y + penalty @ prior
+        self.coeffs[program] = np.linalg.solve(A, b)
+        # rms residual of log(seconds)
+        self.scatter[program] = float(np.sqrt(np.mean((X @ self.coeffs[program] - y)**2)))
+
+    def predict(self, program, npoints, nbytes=0, spherical=False):
+        """ Predicted seconds; vectorized over the arguments """
+        seconds = np.exp(get_features(npoints, nbytes, spherical) @ self.coeffs[program])
+        return seconds if np.ndim(seconds) > 0 else float(seconds)
+
+def load_cost_model(fname=None):
+    """ CostModel fitted to the timings in fname (default get_timings_file()) """
+    return CostModel(read_timings(fname))
@@ -0,0 +1,326 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import numpy as np
+
+from . import utils
+from . import parallel
+from . import synth
+
+def abundance_jacobian(wmin, wmax, dwl, *args,
+                       params=[], step=0.1, central=False,
+                       normalized=True, return_base=False,
+                       linelist=None,
+                       atmosphere=None,
+                       Teff=None, logg=None, MH=None, vt=None,
+                       aFe=None, CFe=None, NFe=None, rFe=None, sFe=None,
+                       twd=None, verbose=False,
+                       costheta=1.0, isotopes={}, marcsfile=True,
+                       spherical=False, Hlinelist=None,
+                       nproc=None,
+):
+    """
+    Finite-difference derivatives of the spectrum with respect to [X/Fe] of several elements.
+
+    The base synthesis and all perturbed syntheses are run in parallel.
+    Elements that do not enter the continuous opacity (see synth.affects_continuum)
+    reuse the babsma_lu opacity of the base model, so they only need bsyn_lu.
+
+    INPUT ARGUMENTS:
+       wmin, wmax, dwl, lists with abundances: the base model, same as run_synth
+
+    KEYWORDS:
+       params= list of elements to differentiate with respect to: Z, element symbol,
+          or (Z, step) to override the step for that element
+       step= (0.1) default step in [X/Fe]
+       central= (False) if True use central differences (two extra syntheses per element),
+          otherwise forward differences (one extra synthesis per element)
+       normalized= (True) differentiate the continuum-normalized spectrum, otherwise the flux
+       return_base= (False) also return the wavelengths and base spectrum
+       nproc= (None) number of syntheses at once; defaults to the number of cpus
+       all other keywords are the same as run_synth
+
+    OUTPUT:
+       jacobian (n_params, n_wave)
+       if return_base: (wavelengths, base spectrum, jacobian)
+    """
+    synth._check_npoints(wmin, wmax, dwl)
+    assert len(params) > 0, "Need at least one element to differentiate"
+    Zs, steps = [], []
+    for param in params:
+        if isinstance(param, (tuple, list)):
+            Z, dX = param
+        else:
+            Z, dX = param, step
+        if isinstance(Z, str): Z = utils.elem_to_Z(Z)
+        assert dX > 0, dX
+        Zs.append(int(Z))
+        steps.append(float(dX))
+
+    star = dict(linelist=linelist, atmosphere=atmosphere, Teff=Teff, logg=logg, MH=MH, vt=vt,
+                aFe=aFe, CFe=CFe, NFe=NFe, rFe=rFe, sFe=sFe, twd=twd, verbose=verbose,
+                costheta=costheta, isotopes=isotopes, marcsfile=marcsfile,
+                spherical=spherical, Hlinelist=Hlinelist)
+    prepared = _prepare_star(wmin, wmax, dwl, star)
+    AM = prepared["atmosphere"].AM
+    base_args = [(int(Z), float(XFe)) for Z, XFe in args]
+    signs = [1, -1] if central else [1]
+    jobs = [("base", base_args)]
+    for Z, dX in zip(Zs, steps):
+        for sign in signs:
+            jobs.append((f"d{Z}{'p' if sign > 0 else 'm'}",
+                         _perturb_abundance(base_args, Z, sign*dX, AM)))
+    spectra = _synth_star(wmin, wmax, dwl, base_args, jobs, star, prepared, nproc)
+
+    icol = 1 if normalized else 2
+    wave, base = spectra[0][0], spectra[0][icol]
+    jacobian = np.zeros((len(Zs), len(wave)))
+    for i, dX in enumerate(steps):
+        if central:
+            plus, minus = spectra[1+2*i][icol], spectra[2+2*i][icol]
+            jacobian[i] = (plus - minus)/(2*dX)
+        else:
+            jacobian[i] = (spectra[1+i][icol] - base)/dX
+    if return_base:
+        return wave, base, jacobian
+    return jacobian
+
+def build_abundance_emulator(wmin, wmax, dwl, *args,
+                             params=[], offsets=(-1.0, -0.5, 0.0, 0.5, 1.0), holdout=True,
+                             normalized=True,
+                             linelist=None,
+                             atmosphere=None,
+                             Teff=None, logg=None, MH=None, vt=None,
+                             aFe=None, CFe=None, NFe=None, rFe=None, sFe=None,
+                             twd=None, verbose=False,
+                             costheta=1.0, isotopes={}, marcsfile=True,
+                             spherical=False, Hlinelist=None,
+                             nproc=None,
+):
+    """
+    Build an AbundanceEmulator for one star: run the spectrum at a few [X/Fe] per element,
+    so that any [X/Fe] can then be interpolated without running Turbospectrum.
+
+    All syntheses run in parallel. Elements that do not enter the continuous opacity
+    (see synth.affects_continuum) reuse the babsma_lu opacity of the base model.
+
+    INPUT ARGUMENTS:
+       wmin, wmax, dwl, lists with abundances: the base model, same as run_synth
+
+    KEYWORDS:
+       params= list of elements to emulate: Z or element symbol
+       offsets= ([-1,-0.5,0,0.5,1]) nodes in [X/Fe] relative to the base [X/Fe] of each element
+          (0 if the element is not in the base model); at least 2
+       holdout= (True) also run the midpoints between the nodes and record the emulator
+          errors there; can also be a list of offsets, or False for none
+       normalized= (True) emulate the continuum-normalized spectrum, otherwise the flux
+       nproc= (None) number of syntheses at once; defaults to the number of cpus
+       all other keywords are the same as run_synth
+
+    OUTPUT:
+       AbundanceEmulator
+    """
+    synth._check_npoints(wmin, wmax, dwl)
+    assert len(params) > 0, "Need at least one element to emulate"
+    Zs = [int(utils.elem_to_Z(Z) if isinstance(Z, str) else Z) for Z in params]
+    assert len(set(Zs)) == len(Zs), f"Elements repeated in {params}"
+    offsets = np.sort(np.asarray(offsets, dtype=float))
+    assert len(offsets) >= 2 and np.all(np.diff(offsets) > 0), offsets
+    if holdout is True:
+        holdout = 0.5*(offsets[1:] + offsets[:-1])
+    elif holdout is False or holdout is None:
+        holdout = []
+    holdout = np.asarray(holdout, dtype=float)
+
+    star = dict(linelist=linelist, atmosphere=atmosphere, Teff=Teff, logg=logg, MH=MH, vt=vt,
+                aFe=aFe, CFe=CFe, NFe=NFe, rFe=rFe, sFe=sFe, twd=twd, verbose=verbose,
+                costheta=costheta, isotopes=isotopes, marcsfile=marcsfile,
+                spherical=spherical, Hlinelist=Hlinelist)
+    prepared = _prepare_star(wmin, wmax, dwl, star)
+    base_args = [(int(Z), float(XFe)) for Z, XFe in args]
+    # Missing elements are at the value the synthesis uses, so the emulator is exact at the base
+    base_XFe = np.array([synth.get_XFe(base_args, Z, prepared["atmosphere"].AM) for Z in Zs])
+    jobs = [("base", base_args)]
+    ijobs = [] # for each element, the job of each node and held-out [X/Fe]
+    for Z, XFe0 in zip(Zs, base_XFe):
+        ijobs.append([])
+        for kind, these_offsets in [("node", offsets), ("holdout", holdout)]:
+            for i, offset in enumerate(these_offsets):
+                if np.round(offset, 3) == 0:
+                    # The base synthesis
+                    ijobs[-1].append(0)
+                    continue
+                ijobs[-1].append(len(jobs))
+                jobs.append((f"{kind}{Z}_{i}", _set_abundance(base_args, Z, XFe0 + offset)))
+    spectra = _synth_star(wmin, wmax, dwl, base_args, jobs, star, prepared, nproc)
+
+    icol = 1 if normalized else 2
+    wave, base = spectra[0][0], spectra[0][icol]
+    spectra = np.array([[spectra[ijob][icol] for ijob in these_ijobs] for these_ijobs in ijobs])
+    emulator = AbundanceEmulator(wave, base, Zs, base_XFe, base_XFe[:,None] + offsets,
+                                 spectra[:,:len(offsets)], normalized=normalized)
+    if len(holdout) > 0:
+        emulator.set_holdout_errors(base_XFe[:,None] + holdout, spectra[:,len(offsets):])
+    return emulator
+
+class AbundanceEmulator(object):
+    """
+    Spectrum of one star as a function of [X/Fe] of several elements, interpolated
+    per pixel with a natural cubic spline through the synthesized nodes of each element.
+    Build it with build_abundance_emulator.
+
+    Elements are combined linearly: for [X/Fe] of several elements the spectrum is
+    base + sum over elements of (spectrum(element at [X/Fe]) - spectrum(element at base)),
+    which holds as long as the elements do not share lines or change the continuum much.
+    [X/Fe] outside the nodes of an element are extrapolated, and much less accurate.
+
+    INPUT ARGUMENTS:
+       wave, base: wavelengths and the spectrum of the base model (n_wave)
+       Zs: the emulated elements (n_params)
+       base_XFe: [X/Fe] of each element in the base model (n_params)
+       nodes: [X/Fe] of the synthesized spectra of each element (n_params, n_nodes)
+       spectra: synthesized spectra (n_params, n_nodes, n_wave)
+       normalized= (True) whether these are continuum-normalized spectra or fluxes
+
+    ATTRIBUTES (after set_holdout_errors):
+       errors: largest absolute error of the emulator at the held-out [X/Fe] (n_params)
+       error_spectrum: per pixel largest absolute error at the held-out [X/Fe] (n_params, n_wave)
+    """
+    def __init__(self, wave, base, Zs, base_XFe, nodes, spectra, normalized=True):
+        super(AbundanceEmulator, self).__init__()
+        self.wave = np.asarray(wave)
+        self.base = np.asarray(base)
+        self.Zs = [int(Z) for Z in Zs]
+        self.base_XFe = np.asarray(base_XFe, dtype=float)
+        self.nodes = np.asarray(nodes, dtype=float)
+        self.spectra = np.asarray(spectra, dtype=float)
+        self.normalized = normalized
+        assert self.nodes.shape[0] == len(self.Zs), self.nodes.shape
+        assert self.spectra.shape == self.nodes.shape + self.wave.shape, self.spectra.shape
+        assert self.base_XFe.shape == (len(self.Zs),), self.base_XFe.shape
+        self.curvature = np.array([_spline_curvature(x, y) for x, y in zip(self.nodes, self.spectra)])
+        self.holdout = None
+        self.errors = None
+        self.error_spectrum = None
+
+    def element_spectra(self, i, XFe):
+        """ Interpolated spectra of element i at the [X/Fe] values XFe (n_query, n_wave) """
+        return _spline_eval(self.nodes[i], self.spectra[i], self.curvature[i], np.atleast_1d(XFe))
+
+    def __call__(self, XFe):
+        """
+        Emulated spectra at [X/Fe] of every element (n_params), or of many trials
+        (n_query, n_params). Returns (n_wave) or (n_query, n_wave).
+        """
+        XFe = np.asarray(XFe, dtype=float)
+        single = XFe.ndim == 1
+        XFe = np.atleast_2d(XFe)
+        assert XFe.shape[1] == len(self.Zs), f"Need [X/Fe] for {len(self.Zs)} elements, got {XFe.shape}"
+        out = np.repeat(self.base[None,:], len(XFe), axis=0)
+        for i in range(len(self.Zs)):
+            out += self.element_spectra(i, XFe[:,i]) - self.element_spectra(i, self.base_XFe[i])
+        return out[0] if single else out
+
+    def set_holdout_errors(self, holdout, spectra):
+        """
+        Compare the emulator to syntheses that are not nodes: holdout are the [X/Fe]
+        of element i in spectra[i] (n_params, n_holdout), other elements at their base.
+        """
+        self.holdout = np.asarray(holdout, dtype=float)
+        spectra = np.asarray(spectra, dtype=float)
+        self.error_spectrum = np.zeros((len(self.Zs), len(self.wave)))
+        for i in range(len(self.Zs)):
+            XFe = np.repeat(self.base_XFe[None,:], len(self.holdout[i]), axis=0)
+            XFe[:,i] = self.holdout[i]
+            self.error_spectrum[i] = np.max(np.abs(self(XFe) - spectra[i]), axis=0)
+        self.errors = np.max(self.error_spectrum, axis=1)
+
+def _spline_curvature(x, y):
+    """
+    Second derivatives at the nodes x (n) of natural cubic splines through the
+    columns of y (n, m), all at once.
+    """
+    n = len(x)
+    M = np.zeros_like(y, dtype=float)
+    if n < 3: return M
+    h = np.diff(x)
+    A = np.zeros((n-2, n-2))
+    A[np.arange(n-2), np.arange(n-2)] = 2*(h[:-1] + h[1:])
+    A[np.arange(n-3), np.arange(1, n-2)] = h[1:-1]
+    A[np.arange(1, n-2), np.arange(n-3)] = h[1:-1]
+    slopes = np.diff(y, axis=0)/h[:,None]
+    M[1:-1] = np.linalg.solve(A, 6*np.diff(slopes, axis=0))
+    return M
+
+def _spline_eval(x, y, M, q):
+    """ Natural cubic splines (nodes x, values y (n, m), curvature M) at q (k); returns (k, m) """
+    j = np.clip(np.searchsorted(x, q) - 1, 0, len(x)-2)
+    h = (x[j+1] - x[j])[:,None]
+    a = (x[j+1][:,None] - q[:,None])/h
+    b = 1 - a
+    return a*y[j] + b*y[j+1] + ((a**3 - a)*M[j] + (b**3 - b)*M[j+1])*h**2/6
+
+def _set_abundance(args, Z, XFe):
+    """ Copy of the [(Z, XFe), ...] list with [X/Fe] of Z set to XFe (added if missing) """
+    new_args = [(Z1, XFe if Z1 == Z else XFe1) for Z1, XFe1 in args]
+    if Z not in [Z1 for Z1, XFe1 in args]:
+        new_args.append((Z, XFe))
+    return new_args
+
+def _prepare_star(wmin, wmax, dwl, star):
+    """
+    Workspace, linelist files, isotopes and atmosphere of one star for _synth_star;
+    star holds the run_synth keywords (atmosphere, vt, linelist, ...)
+    """
+    twd = synth._make_workspace(star["twd"])
+    return dict(twd=twd,
+                linelistfilenames=synth._get_linelistfilenames(star["linelist"], star["Hlinelist"],
+                                                               wmin, wmax),
+                isotopes=synth._validate_isotopes(star["isotopes"]),
+                atmosphere=synth._get_atmosphere(twd, star["atmosphere"], star["Teff"], star["logg"],
+                                                 star["MH"], star["vt"], star["aFe"], star["CFe"],
+                                                 star["NFe"], star["rFe"], star["sFe"]))
+
+def _synth_star(wmin, wmax, dwl, base_args, jobs, star, prepared, nproc=None):
+    """
+    Run syntheses of one star at several abundances in parallel.
+
+    star holds the run_synth keywords and prepared comes from _prepare_star; jobs are
+    (name, [(Z, XFe), ...]). babsma_lu runs once for base_args; jobs with the same
+    abundances of the elements that enter the continuous opacity reuse it, the
+    others run their own. Returns the spectra in the order of jobs.
+    """
+    twd, atmosphere = prepared["twd"], prepared["atmosphere"]
+    linelistfilenames, isotopes = prepared["linelistfilenames"], prepared["isotopes"]
+    marcsfile, spherical, verbose = star["marcsfile"], star["spherical"], star["verbose"]
+    base_abundances = synth.validate_abundances(list(base_args), atmosphere.MH)
+    base_modelopac = synth._run_babsma(twd, wmin, wmax, dwl, atmosphere, base_abundances,
+                                       None, marcsfile, spherical, verbose)
+    base_continuum = _continuum_abundances(base_args)
+
+    def _synth_job(name, job_args):
+        jtwd = synth._make_workspace(os.path.join(twd, name))
+        abundances = synth.validate_abundances(list(job_args), atmosphere.MH)
+        if _continuum_abundances(job_args) == base_continuum:
+            modelopacname = base_modelopac
+        else:
+            modelopacname = synth._run_babsma(jtwd, wmin, wmax, dwl, atmosphere, abundances,
+                                              None, marcsfile, spherical, verbose)
+        outfilename = os.path.join(jtwd, 'bsyn.out')
+        synth._run_bsyn(jtwd, wmin, wmax, dwl, star["costheta"], atmosphere, modelopacname,
+                        abundances, isotopes, linelistfilenames, outfilename,
+                        marcsfile, spherical, verbose)
+        return synth._read_bsyn_output(outfilename)
+
+    return parallel.map_jobs(_synth_job, jobs, nproc=nproc)
+
+def _continuum_abundances(args):
+    """ The [(Z, XFe), ...] entries that change babsma_lu, as a dict """
+    return {Z: XFe for Z, XFe in args if synth.affects_continuum(Z)}
+
+def _perturb_abundance(args, Z, dXFe, AM=0.0):
+    """
+    Copy of the [(Z, XFe), ...] list with [X/Fe] of Z shifted by dXFe. If Z is missing
+    it is added at the value the synthesis uses for it (see synth.get_XFe) plus dXFe.
+    """
+    return _set_abundance(args, Z, synth.get_XFe(args, Z, AM) + dXFe)
@@ -2,14 +2,25 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import re
+import hashlib
+import functools
+import tempfile
 import numpy as np
-from astropy.table import Table
 
 from . import utils
 
 # This probably doesn't work if you install the package
 data_path = os.path.join(os.path.basename(__file__), 'data')
 
+# Hydrogen line wings can reach far: keep H lines within this fraction of
+# their wavelength from the synthesis window (about 330 A for H alpha)
+_Hline_frac_margin = 0.05
+# Lines sampled to estimate the wavelength range of a linelist
+_span_samples = 64
+# A reasonable margin in angstroms for TSLineList(..., margin=) when trimming linelists;
+# strong lines (Ca II, Mg b, Na D) can have wings beyond it
+_line_margin = 10.0
+
 def get_default_linelist(wmin, wmax, species_to_skip=[]):
     """
     Returns default linelists between wmin and wmax (air wavelengths, angstroms)
@@ -17,61 +28,423 @@ def get_default_linelist(wmin, wmax, species_to_skip=[]):
     return TSLineList()
 
 class TSLineList(object):
-    def __init__(self, fname=None):
+    """
+    A Turbospectrum linelist made of one or more source files
+    (e.g. atomic, CN, CH, TiO, MgH and custom lists).
+
+    For a synthesis, get_fname(wmin, wmax) merges the sources species block by
+    species block, drops duplicate lines, and caches the result as one combined
+    file (see combine_linelists). A single source is used as it is.
+
+    By default no lines are dropped. With margin= (in angstroms, e.g. _line_margin)
+    only the lines within margin of the synthesis window are kept, which makes bsyn_lu
+    faster for large linelists but drops the far wings of strong lines.
+    """
+    def __init__(self, fname=None, margin=None):
         super(TSLineList, self).__init__()
-        assert fname is None or os.path.exists(fname)
-        self.fname = fname
+        if fname is None:
+            fnames = []
+        elif isinstance(fname, str):
+            fnames = [fname]
+        else:
+            fnames = list(fname)
+        for this_fname in fnames:
+            assert os.path.exists(this_fname), this_fname
+        self.fnames = fnames
+        self.margin = margin
     
     @staticmethod
     def load(fname, validate=False):
-        assert os.path.exists(fname), fname
-        ll = TSLineList(fname)
+        fnames = [fname] if isinstance(fname, str) else list(fname)
+        for this_fname in fnames:
+            assert os.path.exists(this_fname), this_fname
+        ll = TSLineList(fnames)
         if validate: raise NotImplementedError
         return ll
     
-    def get_fname(self):
-        return self.fname
+    @staticmethod
+    def combine(*linelists):
+        """ One TSLineList with the sources of all linelists (earlier ones win duplicates) """
+        fnames = [fname for ll in linelists for fname in ll.fnames]
+        margins = [ll.margin for ll in linelists if ll.margin is not None]
+        # Trim only if all of them were trimmed, and then by the largest margin
+        margin = max(margins) if len(margins) == len(linelists) and len(margins) > 0 else None
+        return TSLineList(fnames, margin=margin)
+    
+    @property
+    def fname(self):
+        """ The source file if there is only one """
+        if len(self.fnames) == 1: return self.fnames[0]
+        return None
+    
+    def get_fname(self, wmin=None, wmax=None):
+        """
+        Filename to give to bsyn_lu. With one source and no margin or no window, that is
+        just the source; otherwise it is the cached combined file, trimmed to the window
+        if there is a margin (None if no lines are left).
+        """
+        if len(self.fnames) == 0: return None
+        if self.margin is None:
+            wmin, wmax = None, None
+        if len(self.fnames) == 1 and wmin is None and wmax is None:
+            return self.fnames[0]
+        return combine_linelists(self.fnames, wmin, wmax, margin=self.margin or 0.)
+    
+    def get_fnames(self, windows):
+        """
+        get_fname for each (wmin, wmax) of windows. With a margin the sources are
+        combined and trimmed once for the full extent, and that file is cut into the windows.
+        """
+        if len(self.fnames) == 0 or self.margin is None or len(windows) == 1:
+            return [self.get_fname(wmin, wmax) for wmin, wmax in windows]
+        fname = self.get_fname(min([w[0] for w in windows]), max([w[1] for w in windows]))
+        if fname is None: return [None]*len(windows)
+        return split_linelist(fname, windows, margin=self.margin)
     
+    def estimate_bytes(self, wmin, wmax):
+        """
+        Rough size in bytes of get_fname(wmin, wmax) without making it
+        (see estimate_trimmed_bytes); exact for an untrimmed single source
+        """
+        if len(self.fnames) == 0: return 0
+        if self.margin is None:
+            return sum([os.path.getsize(fname) for fname in self.fnames])
+        done, combined = _get_cached(_cache_fname(self.fnames, wmin, wmax, self.margin, 0., True,
+                                                  create=False))
+        if done: return 0 if combined is None else os.path.getsize(combined)
+        return sum([estimate_trimmed_bytes(fname, wmin, wmax, self.margin) for fname in self.fnames])
+    
+    def get_lines(self, wmin=None, wmax=None):
+        """
+        Wavelengths, excitation potentials and log gf of all lines in [wmin, wmax],
+        sorted by wavelength
+        """
+        if len(self.fnames) == 0: return np.zeros(0), np.zeros(0), np.zeros(0)
+        if wmin is None and wmax is None:
+            fname = self.get_fname()
+        else:
+            # Only to read fewer lines, so no margin
+            fname = combine_linelists(self.fnames, wmin, wmax)
+        if fname is None: return np.zeros(0), np.zeros(0), np.zeros(0)
+        lines = [line for block in read_turbospectrum_blocks(fname) for line in block[4]]
+        if len(lines) == 0: return np.zeros(0), np.zeros(0), np.zeros(0)
+        data = np.array([[float(x) for x in line.split()[0:3]] for line in lines])
+        data = data[np.argsort(data[:,0], kind="stable")]
+        if wmin is not None: data = data[data[:,0] >= wmin]
+        if wmax is not None: data = data[data[:,0] <= wmax]
+        return data[:,0], data[:,1], data[:,2]
+    
+def get_cache_dir(create=True):
+    """
+    Directory for cached (trimmed/combined) linelists: $TURBOPY_CACHE if set, else ./tmp/cache.
+    It is made if it does not exist, unless create is False.
+    """
+    cache_dir = os.getenv('TURBOPY_CACHE', os.path.join(os.getcwd(), "tmp", "cache"))
+    if create and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def read_turbospectrum_blocks(fname):
+    """
+    Read a linelist in Turbospectrum format into its species blocks.
+    Returns a list of (species, ion, comment, waves, lines),
+    where lines are the raw line strings and waves their wavelengths.
+    """
+    blocks = []
+    with open(fname) as fp:
+        while True:
+            header = fp.readline()
+            if header == "": break
+            if header.strip() == "": continue
+            match = re.match(r"\s*'(.*)'\s+(\d+)\s+(\d+)", header)
+            if match is None:
+                raise ValueError(f"Could not parse species header in {fname}: {header}")
+            species, ion, N = match.group(1).strip(), int(match.group(2)), int(match.group(3))
+            comment = fp.readline().strip()
+            lines = [fp.readline().rstrip("\n") for i in range(N)]
+            waves = np.array([float(line.split()[0]) for line in lines])
+            blocks.append((species, ion, comment, waves, lines))
+    return blocks
+
+def write_turbospectrum_blocks(blocks, outfname):
+    """
+    Write (species, ion, comment, waves, lines) blocks as a Turbospectrum linelist.
+    Empty blocks are skipped. The file is written atomically, so concurrent
+    writers of the same file are safe. Returns the number of lines written.
+    """
+    Ntot = 0
+    fd, tmpfname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfname)))
+    with os.fdopen(fd, "w") as fp:
+        for species, ion, comment, waves, lines in blocks:
+            if len(lines) == 0: continue
+            fp.write(f"'{species:>7}'      {ion}       {len(lines)}\n")
+            fp.write(f"{comment}\n")
+            for line in lines:
+                fp.write(f"{line}\n")
+            Ntot += len(lines)
+    os.replace(tmpfname, outfname)
+    return Ntot
+
+def trim_blocks(blocks, wmin, wmax, margin=0., frac_margin=0.):
+    """
+    Keep the lines that can reach [wmin, wmax], i.e. lines closer to the window than
+    margin + frac_margin * wavelength
+    """
+    new_blocks = []
+    for species, ion, comment, waves, lines in blocks:
+        reach = margin + frac_margin * waves
+        keep = (waves >= wmin - reach) & (waves <= wmax + reach)
+        new_blocks.append((species, ion, comment, waves[keep],
+                           [line for line, k in zip(lines, keep) if k]))
+    return new_blocks
+
+def merge_blocks(sources, dedup=True):
+    """
+    Merge the (species, ion, comment, waves, lines) blocks of several sources (a list with
+    one list of blocks per source) into one block per species and ion, sorted by species
+    and wavelength like read_vald_long writes them.
+    If dedup, drop lines with the same wavelength, excitation potential and log gf
+    as a line of the same species in an earlier source. Lines within one source are
+    never dropped: e.g. molecular Lambda doublets can have identical values.
+    """
+    merged = {}
+    for blocks in sources:
+        new_keys = {}
+        for species, ion, comment, waves, lines in blocks:
+            key = (float(species), ion)
+            if key not in merged:
+                merged[key] = (species, ion, comment, [], [], set())
+            seen = merged[key][5]
+            for wave, line in zip(waves, lines):
+                if dedup:
+                    linekey = (np.round(wave, 3),) + tuple(np.round([float(x) for x in line.split()[1:3]], 3))
+                    if linekey in seen: continue
+                    new_keys.setdefault(key, set()).add(linekey)
+                merged[key][3].append(wave)
+                merged[key][4].append(line)
+        for key in new_keys:
+            merged[key][5].update(new_keys[key])
+    new_blocks = []
+    for key in sorted(merged):
+        species, ion, comment, waves, lines, seen = merged[key]
+        waves = np.array(waves)
+        ii = np.argsort(waves, kind="stable")
+        new_blocks.append((species, ion, comment, waves[ii], [lines[i] for i in ii]))
+    return new_blocks
+
+def _cache_fname(fnames, wmin, wmax, margin, frac_margin, dedup, create=True):
+    """ Name of the cached file for a combination of sources, window and margins """
+    fnames = [os.path.abspath(fname) for fname in fnames]
+    key = []
+    for fname in fnames:
+        stat = os.stat(fname)
+        key.append(f"{fname}|{stat.st_mtime_ns}|{stat.st_size}")
+    key.append(f"{wmin:.3f}|{wmax:.3f}|{margin}|{frac_margin}|{dedup}")
+    key = hashlib.md5("|".join(key).encode("utf-8")).hexdigest()
+    base = os.path.basename(fnames[0]) if len(fnames) == 1 else "combined"
+    return os.path.join(get_cache_dir(create), f"{base}-{wmin:.3f}-{wmax:.3f}-{key[:12]}")
+
+def _get_cached(outfname):
+    """ (True, filename or None) if outfname was already made, else (False, None) """
+    if os.path.exists(outfname): return True, outfname
+    if os.path.exists(outfname + ".empty"): return True, None
+    return False, None
+
+def _write_cached(blocks, outfname):
+    """ Write blocks to the cache file outfname; returns it, or None if there are no lines """
+    if sum(len(block[4]) for block in blocks) == 0:
+        # Remember that there is nothing here, bsyn_lu does not like empty linelists
+        open(outfname + ".empty", "w").close()
+        return None
+    write_turbospectrum_blocks(blocks, outfname)
+    return outfname
+
+def combine_linelists(fnames, wmin=None, wmax=None, margin=0., frac_margin=0., dedup=True):
+    """
+    Returns the filename of one cached Turbospectrum linelist combining the files fnames:
+    species blocks are merged (see merge_blocks) and, if a window is given, trimmed
+    to the lines that can reach [wmin, wmax] (see trim_blocks).
+    The file is only made once per set of sources, window and margins.
+    Returns None if no lines are left.
+    """
+    if wmin is None: wmin = -np.inf
+    if wmax is None: wmax = np.inf
+    outfname = _cache_fname(fnames, wmin, wmax, margin, frac_margin, dedup)
+    done, fname = _get_cached(outfname)
+    if done: return fname
+    sources = [trim_blocks(read_turbospectrum_blocks(fname), wmin, wmax, margin, frac_margin)
+               for fname in fnames]
+    return _write_cached(merge_blocks(sources, dedup=dedup), outfname)
+
+def split_linelist(fname, windows, margin=0., frac_margin=0.):
+    """
+    Cached copies of the Turbospectrum linelist fname trimmed to each (wmin, wmax)
+    of windows, like get_trimmed_linelist, but reading fname at most once.
+    Returns one filename (None if no lines are left) per window.
+    """
+    blocks = None
+    outfnames = []
+    for wmin, wmax in windows:
+        outfname = _cache_fname([fname], wmin, wmax, margin, frac_margin, False)
+        done, this_fname = _get_cached(outfname)
+        if not done:
+            if blocks is None: blocks = read_turbospectrum_blocks(fname)
+            this_fname = _write_cached(trim_blocks(blocks, wmin, wmax, margin, frac_margin), outfname)
+        outfnames.append(this_fname)
+    return outfnames
+
+def get_trimmed_linelist(fname, wmin, wmax, margin=0., frac_margin=0.):
+    """
+    Returns the filename of a cached copy of the Turbospectrum linelist fname,
+    trimmed to the lines that can reach [wmin, wmax] (see trim_blocks).
+    Returns None if no lines are left.
+    """
+    return combine_linelists([fname], wmin, wmax, margin=margin,
+                             frac_margin=frac_margin, dedup=False)
+
+@functools.lru_cache(maxsize=None)
+def _sample_wave_span(fname, mtime_ns, size):
+    """
+    (min, max) wavelength of a Turbospectrum linelist from a few lines at evenly spaced
+    offsets, so a multi-GB file is not read; (nan, nan) if no line was found
+    """
+    waves = []
+    with open(fname, "rb") as fp:
+        for offset in np.linspace(0, size, _span_samples, endpoint=False).astype(int):
+            fp.seek(offset)
+            fp.readline() # the rest of a line, or a header
+            try:
+                waves.append(float(fp.readline().split()[0]))
+            except (IndexError, ValueError):
+                continue # a header or comment
+    if len(waves) == 0: return np.nan, np.nan
+    return min(waves), max(waves)
+
+def estimate_trimmed_bytes(fname, wmin, wmax, margin=0., frac_margin=0.):
+    """
+    Rough size in bytes of get_trimmed_linelist(fname, wmin, wmax, margin, frac_margin),
+    without making it: the size of the cached file if it was already made, else the size
+    of fname times the fraction of its wavelength range that can reach the window
+    """
+    done, trimmed = _get_cached(_cache_fname([fname], wmin, wmax, margin, frac_margin, False,
+                                             create=False))
+    if done: return 0 if trimmed is None else os.path.getsize(trimmed)
+    stat = os.stat(fname)
+    lo, hi = _sample_wave_span(os.path.abspath(fname), stat.st_mtime_ns, stat.st_size)
+    if not hi > lo: return stat.st_size
+    reach = margin + frac_margin*wmax
+    frac = (min(hi, wmax + reach) - max(lo, wmin - reach))/(hi - lo)
+    return int(stat.st_size*np.clip(frac, 0., 1.))
+
+def estimate_Hlinelist_bytes(wmin, wmax, Hlinelist=None):
+    """ Rough size of the hydrogen linelist bsyn_lu gets for [wmin, wmax], without making it """
+    if Hlinelist is not None:
+        return os.path.getsize(Hlinelist) if os.path.exists(Hlinelist) else 0
+    turbodata = os.getenv('TURBODATA')
+    if turbodata is None or not os.path.exists(os.path.join(turbodata, 'Hlinedata')):
+        return 0
+    return estimate_trimmed_bytes(os.path.join(turbodata, 'Hlinedata'), wmin, wmax,
+                                  frac_margin=_Hline_frac_margin)
+
+def get_trimmed_Hlinelists(windows):
+    """
+    get_trimmed_Hlinelist for each (wmin, wmax) of windows, cut from the hydrogen
+    lines of the full extent so Hlinedata is read only once
+    """
+    if len(windows) == 1:
+        return [get_trimmed_Hlinelist(*windows[0])]
+    fname = get_trimmed_Hlinelist(min([w[0] for w in windows]), max([w[1] for w in windows]))
+    if fname is None or fname == 'DATA/Hlinedata':
+        return [fname]*len(windows)
+    return split_linelist(fname, windows, frac_margin=_Hline_frac_margin)
+
+def get_trimmed_Hlinelist(wmin, wmax):
+    """
+    Returns the filename of Turbospectrum's DATA/Hlinedata trimmed to the hydrogen lines
+    whose wings can reach [wmin, wmax], or None if there are none.
+    Falls back to 'DATA/Hlinedata' if $TURBODATA/Hlinedata is not available.
+    """
+    turbodata = os.getenv('TURBODATA')
+    if turbodata is None or not os.path.exists(os.path.join(turbodata, 'Hlinedata')):
+        return 'DATA/Hlinedata'
+    return get_trimmed_linelist(os.path.join(turbodata, 'Hlinedata'), wmin, wmax,
+                                frac_margin=_Hline_frac_margin)
+
+_orbital_letters = {x: i for i, x in enumerate("spdfghik")}
+_coupling_schemes = ["LS","JJ","JK","LK"]
+
+@functools.lru_cache(maxsize=None)
+def _parse_configuration(l):
+    """
+    (last, second to last) orbital of the configuration in a VALD term line as indices
+    into spdfghik (-1 if missing), or None if the coupling scheme is not known
+    """
+    split = l.split()
+    if len(split)==0 or split[0] not in _coupling_schemes: return None
+    this_levels = re.findall(r"[spdfghik]", split[1])
+    # Going to try last 2 levels of configuration
+    last = _orbital_letters[this_levels[-1]] if len(this_levels) >= 1 else -1
+    last2 = _orbital_letters[this_levels[-2]] if len(this_levels) >= 2 else -1
+    return last, last2
+
 def _get_levels(l2, l3):
     """ Solve for orbit levels """
-    s2 = l2.split()
-    s3 = l3.split()
-    all_levels = ["s","p","d","f","g","h","i","k"]
-    levels = []
-    for split in [s2, s3]:
-        if len(split)==0 or split[0] not in ["LS","JJ","JK","LK"]: return "X", "X"
-        configuration = split[1]
-        this_levels = re.findall(r"[spdfghik]", configuration)
-        # Going to try last 2 levels of configuration
-        try:
-            levels.append(all_levels.index(this_levels[-1]))
-        except IndexError:
-            levels.append(-1)
-        try:
-            levels.append(all_levels.index(this_levels[-2]))
-        except IndexError:
-            levels.append(-1)
-    llo, llo2, lhi, lhi2 = levels
+    levlo, levup = _get_levels_batch([l2], [l3])
+    return str(levlo[0]), str(levup[0])
+
+def _get_levels_batch(l2s, l3s):
+    """
+    Solve for orbit levels of many lines at once.
+    Each unique configuration is only parsed once, and the selection rules are
+    applied to all lines with array operations. Returns arrays levlo, levup.
+    """
+    l2s = np.asarray(l2s, dtype=str)
+    l3s = np.asarray(l3s, dtype=str)
+    N = len(l2s)
+    levels = np.full((N, 4), -1)
+    valid = np.ones(N, dtype=bool)
+    for icol, ls in [(0, l2s), (2, l3s)]:
+        uls, inverse = np.unique(ls, return_inverse=True)
+        ulevels = np.full((len(uls), 2), -1)
+        uvalid = np.ones(len(uls), dtype=bool)
+        for i, l in enumerate(uls):
+            parsed = _parse_configuration(str(l))
+            if parsed is None: uvalid[i] = False
+            else: ulevels[i] = parsed
+        inverse = inverse.ravel()
+        levels[:,icol:icol+2] = ulevels[inverse]
+        valid &= uvalid[inverse]
+    llo, llo2, lhi, lhi2 = levels.T.copy()
     ## Some updates from vald3line-BPz-freeformat to make the transition match best
-    if llo >= 3 or lhi >= 3:
-        llo, lhi = 2, 3
-    elif (llo < 0) & (lhi < 0):
-        return "X","X"
-    elif np.abs(lhi - llo) == 1:
-        pass # keep these
-    elif llo2 >= 3 or lhi2 >= 3: # going to second 
-        llo, lhi = 2, 3
-    else:
-        ixrow, ixcol = 4*llo + llo2+1, 4*lhi + lhi2+1
-        llo, lhi = _all_level_map[ixrow, ixcol]
-    all_levels = ["s","p","d","f"]
-    return all_levels[llo], all_levels[lhi]
+    ## The order of the rules matters, done is set once a rule applies
+    isX = ~valid
+    done = isX.copy()
+    ii = ~done & ((llo >= 3) | (lhi >= 3))
+    llo[ii], lhi[ii] = 2, 3
+    done |= ii
+    ii = ~done & (llo < 0) & (lhi < 0)
+    isX |= ii
+    done |= ii
+    done |= np.abs(lhi - llo) == 1 # keep these
+    ii = ~done & ((llo2 >= 3) | (lhi2 >= 3)) # going to second 
+    llo[ii], lhi[ii] = 2, 3
+    done |= ii
+    ii = ~done
+    ixrow, ixcol = 4*llo[ii] + llo2[ii]+1, 4*lhi[ii] + lhi2[ii]+1
+    llo[ii], lhi[ii] = _all_level_map[ixrow, ixcol].T
+    all_levels = np.array(["s","p","d","f"])
+    # Negative indices pick "f" like the original list indexing did
+    levlo = np.where(isX, "X", all_levels[np.where(isX, 0, llo)])
+    levup = np.where(isX, "X", all_levels[np.where(isX, 0, lhi)])
+    return levlo, levup
 
 def read_vald_long(fname, outfname=None):
     """
     This code is meant to mimic vald3line-BPz-freeformat.f
     but fix issues with molecules etc
     """
+    # astropy is slow to import, and only needed here
+    from astropy.table import Table
     fdampdict1 = {11: 2.0, 14: 1.3, 20: 1.8, 26: 1.4} # neutral damping, the rest are 2.5
     fdampdict2 = {20: 1.4, 38: 1.8, 56: 3.0} # ionized damping, the rest are 2.5
     def _should_skip(data):
@@ -104,40 +477,8 @@ def read_vald_long(fname, outfname=None):
             specion, wave, loggf, expot, jlo, ehi, jhi, lower, upper, mean, Rad, Stark, Waals = s1[:13]
         except ValueError as e:
             raise FinishedReading
-        jhi = float(jhi)
-        Rad = float(Rad)
-        Waals = float(Waals)
-        
-        elems, ion, isos = utils.identify_fullspecstr(specion, s4[-1])
-        Zs = [utils.elem_to_Z(el) for el in elems]
-        tspecies = utils.make_tspecies(Zs, isos)
-        inttspecies = int(float(tspecies))
-        
-        ## Damping atomic data
-        if Waals != 0:
-            fdamp = Waals
-        elif ion == 1 and inttspecies in fdampdict1:
-            fdamp = fdampdict1[inttspecies]
-        elif ion == 1 and inttspecies in fdampdict2:
-            fdamp = fdampdict2[inttspecies]
-        else:
-            fdamp = 2.5
-        
-        gu = 2*jhi + 1
-        if Rad > 3.0: raddmp = 10**Rad
-        else: raddmp = 1.e5
-        
-        critehi = 999999.
-        if len(elems) == 1: # an atom
-            levlo, levup = _get_levels(l2, l3)
-            if ion == 1: critehi = utils.get_ionp1(elems[0])
-            elif ion == 2: critehi = utils.get_ionp2(elems[0])
-        else: # a molecule
-            fdamp = 2.500 
-            levlo, levup = "X", "X"
-        
-        return tspecies, ion, float(wave), float(expot), float(loggf), fdamp, gu, raddmp, \
-            levlo, levup, float(ehi), critehi
+        return specion, s4[-1], float(wave), float(loggf), float(expot), float(ehi), \
+            float(jhi), float(Rad), float(Waals), l2, l3
     
     alldata = []
     with open(fname) as fp:
@@ -150,7 +491,44 @@ def read_vald_long(fname, outfname=None):
             alldata.append(out)
     cols = ["tspecies","ion","wave","expot","loggf","fdamp","gu","raddmp",
             "levlo","levup","ehi", "critehi"]
-    tab = Table(rows=alldata, names=cols)
+    if len(alldata) == 0:
+        # No lines: an empty table and an empty file
+        tab = Table([np.zeros(0) for col in cols + ["sortspecies"]], names=cols + ["sortspecies"])
+        if outfname is not None:
+            open(outfname, "w").close()
+        return tab
+    specion, fullspecstr, wave, loggf, expot, ehi, jhi, Rad, Waals, l2, l3 = \
+        [np.array(x) for x in zip(*alldata)]
+    
+    ## Species are worked out once per unique string
+    Zs, ion, isos, nelem, tspecies = utils.identify_species(specion, fullspecstr)
+    inttspecies = tspecies.astype(float).astype(int)
+    isatom = nelem == 1
+    
+    ## Damping atomic data
+    fdamp = np.full(len(wave), 2.5)
+    # fdampdict1 takes precedence, so it goes last
+    for fdampdict in [fdampdict2, fdampdict1]:
+        for Z, damp in fdampdict.items():
+            fdamp[(ion == 1) & (inttspecies == Z)] = damp
+    fdamp = np.where(Waals != 0, Waals, fdamp)
+    fdamp[~isatom] = 2.500
+    
+    gu = 2*jhi + 1
+    # Python's pow, to match the per-line values to the last bit
+    raddmp = np.array([10**R if R > 3.0 else 1.e5 for R in Rad.tolist()])
+    
+    critehi = np.full(len(wave), 999999.)
+    ii1, ii2 = isatom & (ion == 1), isatom & (ion == 2)
+    critehi[ii1] = utils.get_ionp1(Zs[ii1,0])
+    critehi[ii2] = utils.get_ionp2(Zs[ii2,0])
+    
+    levlo, levup = np.full(len(wave), "X"), np.full(len(wave), "X")
+    if isatom.any():
+        levlo[isatom], levup[isatom] = _get_levels_batch(l2[isatom], l3[isatom])
+    
+    tab = Table([tspecies, ion, wave, expot, loggf, fdamp, gu, raddmp,
+                 levlo, levup, ehi, critehi], names=cols)
     
     ## Cut lines
     tab["sortspecies"] = tab["tspecies"].astype(float) + 0.0000001 * tab["ion"]
@@ -0,0 +1,121 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+def get_nproc(nproc=None):
+    """ Number of jobs to run at once: nproc if given, else the number of cpus """
+    if nproc is None:
+        nproc = os.cpu_count() or 1
+    assert nproc >= 1, nproc
+    return int(nproc)
+
+def map_jobs(func, jobs, nproc=None):
+    """
+    Call func(*job) for every job in jobs, running up to nproc at once.
+    Returns the results in the same order as jobs.
+
+    The expensive part of every job is a Turbospectrum subprocess,
+    so threads are enough to keep nproc cores busy.
+    """
+    jobs = [tuple(job) for job in jobs]
+    nproc = min(get_nproc(nproc), max(len(jobs), 1))
+    if nproc == 1:
+        return [func(*job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        futures = [pool.submit(func, *job) for job in jobs]
+        return [future.result() for future in futures]
+
+def _attach(name):
+    """ Attach to an existing shared memory block without handing it to this process' resource tracker """
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+class SharedSpectra(object):
+    """
+    The (wave, norm, flux) results of many jobs in one shared memory block,
+    so worker processes can write their spectra where the parent reads them,
+    with no pickling or copying.
+
+    Job i has room for capacities[i] points. The parent creates the block
+    (name=None) and owns it; workers attach with SharedSpectra.attach and write
+    their job with write(i, ...). Indexing gives (wave, norm, flux) views into the
+    block for the number of points written, which the parent has to record with
+    set_length (write does that in the process that writes).
+
+    The views are only valid until close(), which also frees the block if this is
+    the owner. Use it as a context manager to make that explicit.
+    """
+    def __init__(self, capacities, name=None):
+        super(SharedSpectra, self).__init__()
+        from multiprocessing import shared_memory
+        self.capacities = np.asarray(capacities, dtype=int)
+        self.offsets = np.concatenate([[0], np.cumsum(self.capacities)]).astype(int)
+        self.lengths = np.zeros(len(self.capacities), dtype=int)
+        npoints = int(self.offsets[-1])
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(3*8*npoints, 1))
+            self.owner = True
+        else:
+            self.shm = _attach(name)
+            self.owner = False
+        self.data = np.ndarray((3, npoints), dtype=np.float64, buffer=self.shm.buf)
+
+    @staticmethod
+    def attach(name, capacities):
+        return SharedSpectra(capacities, name=name)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, i, wave, norm, flux):
+        """ Copy one job's spectrum into the block; returns its number of points """
+        n = len(wave)
+        if n > self.capacities[i]:
+            raise ValueError(f"Job {i} has {n} points, but only room for {self.capacities[i]}")
+        off = self.offsets[i]
+        self.data[0, off:off+n] = wave
+        self.data[1, off:off+n] = norm
+        self.data[2, off:off+n] = flux
+        self.lengths[i] = n
+        return n
+
+    def set_length(self, i, n):
+        assert 0 <= n <= self.capacities[i], (i, n)
+        self.lengths[i] = n
+
+    def __len__(self):
+        return len(self.capacities)
+    def __getitem__(self, i):
+        if i < 0: i += len(self)
+        off, n = self.offsets[i], self.lengths[i]
+        return self.data[0, off:off+n], self.data[1, off:off+n], self.data[2, off:off+n]
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def close(self):
+        """ Release the block; views from it must not be used after this """
+        if self.shm is None: return
+        self.data = None
+        if self.owner:
+            self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            # Someone still holds a view; the mapping goes away with the last view
+            pass
+        self.shm = None
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+        return False
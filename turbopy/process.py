@@ -0,0 +1,224 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import tempfile
+import subprocess
+
+try:
+    import fcntl
+except ImportError: # not on POSIX, only the per-stage limits apply
+    fcntl = None
+
+# Defaults for every Turbospectrum run; change them with set_limits
+_limits = dict(
+    timeout={"babsma_lu": 600., "bsyn_lu": 3600.}, # seconds of wall time per stage
+    max_memory=None, # bytes of address space (RLIMIT_AS) per process
+    max_cpu_time=None, # seconds of cpu time (RLIMIT_CPU) per process
+    retries=1, # extra attempts after a failed run
+    max_procs=None, # Turbospectrum processes at once on this node; default is the number of cpus
+    lockdir=None, # where the per-node slot lock files live; default is the system tmp dir
+)
+_slot_poll = 0.05 # seconds between attempts to get a process slot
+_output_tail = 20 # lines of program output kept in errors
+
+class TurbospectrumError(RuntimeError):
+    """
+    A babsma_lu or bsyn_lu run failed.
+    reason is one of "timeout", "returncode", "output", "launch".
+    """
+    def __init__(self, program, twd, reason, returncode=None, output=None, attempts=1, message=None):
+        self.program = program
+        self.twd = twd
+        self.reason = reason
+        self.returncode = returncode
+        self.output = output
+        self.attempts = attempts
+        if message is None:
+            message = f"Running {program} failed ({reason}"
+            if returncode is not None: message += f", return code {returncode}"
+            message += f", {attempts} attempt{'s' if attempts > 1 else ''}) in {twd}"
+        self.message = message
+        if output:
+            message += "\nLast output:\n" + output
+        super(TurbospectrumError, self).__init__(message)
+
+    def __reduce__(self):
+        # So that errors can be sent between processes
+        return (TurbospectrumError, (self.program, self.twd, self.reason, self.returncode,
+                                     self.output, self.attempts, self.message))
+
+def get_limits():
+    """ Copy of the current limits for Turbospectrum runs """
+    limits = dict(_limits)
+    limits["timeout"] = dict(_limits["timeout"])
+    return limits
+
+def set_limits(**kwargs):
+    """
+    Set limits for all later Turbospectrum runs:
+       timeout= dict of program -> seconds of wall time, or one number for all programs
+       max_memory= bytes of address space per process (None for no limit)
+       max_cpu_time= seconds of cpu time per process (None for no limit)
+       retries= extra attempts after a failed run
+       max_procs= Turbospectrum processes at once on this node (None for the number of cpus)
+       lockdir= directory shared by all processes on the node for the slot locks
+    """
+    for key, value in kwargs.items():
+        if key not in _limits:
+            raise ValueError(f"Unknown limit '{key}', should be one of {list(_limits)}")
+        if key == "timeout" and not isinstance(value, dict):
+            value = {program: value for program in _limits["timeout"]}
+        if key == "timeout":
+            _limits["timeout"].update(value)
+        else:
+            _limits[key] = value
+    assert int(_limits["retries"]) >= 0, _limits["retries"]
+
+def get_max_procs():
+    max_procs = _limits["max_procs"]
+    if max_procs is None:
+        max_procs = int(os.getenv("TURBOPY_MAX_PROCS", os.cpu_count() or 1))
+    assert max_procs >= 1, max_procs
+    return max_procs
+
+def _open_slot(fname):
+    """
+    Read-only descriptor of a slot lock file, creating it if needed. flock does not
+    need write access, so every user on the node can share files another one created.
+    """
+    try:
+        return os.open(fname, os.O_RDONLY)
+    except FileNotFoundError:
+        pass
+    try:
+        fd = os.open(fname, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError: # created by another process meanwhile
+        return os.open(fname, os.O_RDONLY)
+    # readable by everyone, whatever the umask
+    os.fchmod(fd, 0o644)
+    return fd
+
+class _ProcessSlot(object):
+    """
+    One of max_procs slots for running Turbospectrum on this node.
+    The slots are lock files, so they are shared by all threads, processes and users.
+    """
+    def __init__(self, program=None, twd=None):
+        super(_ProcessSlot, self).__init__()
+        self.program = program
+        self.twd = twd
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is None: return self
+        lockdir = _limits["lockdir"] or tempfile.gettempdir()
+        max_procs = get_max_procs()
+        while True:
+            for i in range(max_procs):
+                fname = os.path.join(lockdir, f"turbopy-slot-{i}.lock")
+                try:
+                    fd = _open_slot(fname)
+                except OSError as e:
+                    raise TurbospectrumError(self.program, self.twd, "launch",
+                                             message=f"Could not open the process slot {fname}: {e}; "
+                                             "use set_limits(lockdir=...) to pick another directory")
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    os.close(fd)
+                    continue
+                self.fd = fd
+                return self
+            time.sleep(_slot_poll)
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        return False
+
+def _get_ulimits():
+    """ ulimit options for the memory and cpu limits that are set """
+    ulimits = []
+    if os.name != "posix": return ulimits
+    if _limits["max_memory"] is not None:
+        ulimits.append(f"-v {int(_limits['max_memory'])//1024}") # in kB
+    if _limits["max_cpu_time"] is not None:
+        ulimits.append(f"-t {int(_limits['max_cpu_time'])}")
+    return ulimits
+
+def _get_command(executable):
+    """
+    The command that runs executable under the limits. A shell sets them and execs the
+    program, since setting them in a preexec_fn is not safe while other threads run.
+    """
+    ulimits = _get_ulimits()
+    if not ulimits: return [executable]
+    # The program only runs if all the limits could be set
+    setup = " && ".join([f"ulimit {option}" for option in ulimits])
+    return ["/bin/sh", "-c", setup + ' && exec "$0"', executable]
+
+def _tail(logfilename):
+    if logfilename is None or not os.path.exists(logfilename): return None
+    with open(logfilename, errors="replace") as fp:
+        return "".join(fp.readlines()[-_output_tail:])
+
+def _run_once(executable, twd, script, logfilename, timeout):
+    """ Returns (reason, returncode) of a failure, or (None, 0) """
+    program = os.path.basename(executable)
+    # Checked here, since a shell setting the limits would start even if the program cannot
+    if not os.access(executable, os.X_OK):
+        raise TurbospectrumError(program, twd, "launch", message=f"Could not start {executable}: not an executable file")
+    logfp = None if logfilename is None else open(logfilename, "w")
+    try:
+        try:
+            p = subprocess.Popen(_get_command(executable), cwd=twd,
+                                 stdin=subprocess.PIPE,
+                                 stdout=logfp,
+                                 stderr=None if logfp is None else subprocess.STDOUT)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise TurbospectrumError(program, twd, "launch", message=f"Could not start {executable}: {e}")
+        try:
+            p.communicate(script, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            return "timeout", p.returncode
+    finally:
+        if logfp is not None: logfp.close()
+    if p.returncode != 0:
+        return "returncode", p.returncode
+    return None, 0
+
+def run_program(executable, twd, parfilename, verbose=False, outfiles=[]):
+    """
+    Run a Turbospectrum program in twd with the script parfilename on stdin,
+    under the limits from set_limits. The run fails if it times out, has a
+    non-zero return code, or does not write all of outfiles; failed runs are
+    retried. Raises TurbospectrumError once the retries are used up.
+    Returns the wall time in seconds of the successful attempt.
+
+    Unless verbose, the program output goes to <program>.log in twd.
+    """
+    program = os.path.basename(executable)
+    timeout = _limits["timeout"].get(program)
+    ntries = 1 + int(_limits["retries"])
+    logfilename = None if verbose else os.path.join(twd, f"{program}.log")
+    with open(parfilename, "rb") as parfile:
+        script = parfile.read()
+    for attempt in range(1, ntries+1):
+        for outfile in outfiles:
+            if os.path.exists(outfile): os.remove(outfile)
+        with _ProcessSlot(program, twd):
+            # Not counting the wait for a slot
+            start = time.monotonic()
+            reason, returncode = _run_once(executable, twd, script, logfilename, timeout)
+            seconds = time.monotonic() - start
+        if reason is None and not all(os.path.exists(f) and os.path.getsize(f) > 0 for f in outfiles):
+            reason = "output"
+        if reason is None:
+            return seconds
+    raise TurbospectrumError(program, twd, reason, returncode=returncode,
+                             output=_tail(logfilename), attempts=ntries)
@@ -0,0 +1,300 @@
+"""
+A long-lived local synthesis server.
+
+One server per node owns the workers, their workspaces and the opacity cache.
+Many client processes send it run_synth requests over a Unix socket; requests
+run in priority order, identical requests in flight are only run once, and the
+spectra come back through shared memory.
+
+Start it with
+    python -m turbopy.server --nproc 16
+and in the clients use turbopy.server.run_synth instead of turbopy.run_synth.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import queue
+import pickle
+import hashlib
+import argparse
+import itertools
+import tempfile
+import threading
+from multiprocessing.connection import Listener, Client
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from . import synth
+from . import parallel
+
+def get_default_address():
+    """ $TURBOPY_SERVER if set, else a per-user Unix socket in the system tmp dir """
+    return os.getenv("TURBOPY_SERVER",
+                     os.path.join(tempfile.gettempdir(), f"turbopy-{os.getuid()}.sock"))
+
+class _Request(object):
+    """ One unique synthesis, shared by every client waiting for it """
+    def __init__(self, key, args, kwargs, priority):
+        super(_Request, self).__init__()
+        self.key = key
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.started = False
+        self.waiters = []
+
+class SynthServer(object):
+    """
+    Runs run_synth requests from many clients.
+
+    INPUT ARGUMENTS:
+       address= (None) Unix socket to listen on; defaults to get_default_address()
+       nproc= (None) number of syntheses at once; defaults to the number of cpus
+       workdir= (None) directory for the worker workspaces and opacity cache;
+          defaults to a new directory in ./tmp
+
+    Requests with a higher priority run first. Requests that do not give
+    modelopac share babsma_lu runs through the opacity cache (see synth.opacity_key).
+    """
+    def __init__(self, address=None, nproc=None, workdir=None):
+        super(SynthServer, self).__init__()
+        self.address = address or get_default_address()
+        self.nproc = parallel.get_nproc(nproc)
+        if workdir is None:
+            workdir = tempfile.mkdtemp(dir=os.getcwd()+"/tmp")
+        self.workdir = os.path.abspath(workdir)
+        self.opacity_dir = os.path.join(self.workdir, "opacities")
+        os.makedirs(self.opacity_dir, exist_ok=True)
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._opacity_locks = {}
+        self._stop = threading.Event()
+        self._threads = []
+        self._listener = None
+        self.nrequests = 0
+        self.nsynth = 0
+
+    def submit(self, args, kwargs, priority=0):
+        """
+        Queue a synthesis and return a queue that will get ("ok", (wave, norm, flux))
+        or ("error", exception). An identical request that has not finished is joined.
+        """
+        key = hashlib.md5(pickle.dumps((args, sorted(kwargs.items())))).hexdigest()
+        result = queue.Queue(1)
+        with self._lock:
+            self.nrequests += 1
+            request = self._inflight.get(key)
+            if request is None:
+                request = _Request(key, args, kwargs, priority)
+                self._inflight[key] = request
+                self._queue.put((-priority, next(self._counter), request))
+            elif priority > request.priority and not request.started:
+                # Queue it again at the higher priority, the old entry is skipped
+                request.priority = priority
+                self._queue.put((-priority, next(self._counter), request))
+            request.waiters.append(result)
+        return result
+
+    def start(self):
+        """
+        Start the workers and the listener in background threads.
+        Raises RuntimeError if another server is listening on the address.
+        """
+        if os.path.exists(self.address):
+            try:
+                Client(self.address, family="AF_UNIX").close()
+            except OSError:
+                # Left over from a server that is gone
+                os.remove(self.address)
+            else:
+                raise RuntimeError(f"A server is already listening on {self.address}")
+        # Only this user can connect: the socket is created with these permissions,
+        # since requests are unpickled
+        umask = os.umask(0o177)
+        try:
+            self._listener = Listener(self.address, family="AF_UNIX")
+        finally:
+            os.umask(umask)
+        for i in range(self.nproc):
+            self._start_thread(self._work, i)
+        self._start_thread(self._accept)
+        return self
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self._stop.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self._stop.set()
+        if self._listener is not None:
+            # Wake up the accept thread
+            try:
+                Client(self.address, family="AF_UNIX").close()
+            except OSError:
+                pass
+            self._listener.close()
+            self._listener = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if os.path.exists(self.address): os.remove(self.address)
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _work(self, i):
+        # Each worker reuses one workspace; run_synth links DATA into it
+        twd = os.path.join(self.workdir, f"worker{i:03}")
+        os.makedirs(twd, exist_ok=True)
+        while not self._stop.is_set():
+            try:
+                priority, count, request = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            with self._lock:
+                if request.started: continue
+                request.started = True
+            try:
+                outcome = ("ok", self._synth(request, twd))
+            except Exception as e:
+                outcome = ("error", e)
+            with self._lock:
+                del self._inflight[request.key]
+                self.nsynth += 1
+            for result in request.waiters:
+                result.put(outcome)
+
+    def _synth(self, request, twd):
+        kwargs = dict(request.kwargs)
+        kwargs.setdefault("twd", twd)
+        if kwargs.get("modelopac") is not None:
+            return synth.run_synth(*request.args, **kwargs)
+        wmin, wmax, dwl = request.args[:3]
+        key = synth.opacity_key(wmin, wmax, dwl, request.args[3:],
+                                kwargs.get("atmosphere"), kwargs.get("vt"),
+                                kwargs.get("marcsfile", True), kwargs.get("spherical", False))
+        if key is None:
+            return synth.run_synth(*request.args, **kwargs)
+        kwargs["modelopac"] = os.path.join(self.opacity_dir, key)
+        if not os.path.exists(kwargs["modelopac"]):
+            # The first request for this opacity computes it, the others wait for
+            # only that babsma_lu run; bsyn_lu runs outside the lock
+            with self._lock:
+                opacity_lock = self._opacity_locks.setdefault(key, threading.Lock())
+            with opacity_lock:
+                if not os.path.exists(kwargs["modelopac"]):
+                    synth._run_shared_babsma(os.path.join(twd, "opacity"), request.args,
+                                             kwargs, kwargs["modelopac"])
+        return synth.run_synth(*request.args, **kwargs)
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                break
+            if self._stop.is_set():
+                conn.close()
+                break
+            # Not joined on shutdown: idle clients can keep their connection open
+            threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+    def _serve_client(self, conn):
+        """ Handle the requests of one client connection """
+        with conn:
+            while not self._stop.is_set():
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                kind = message[0]
+                if kind == "stats":
+                    conn.send(("ok", dict(nrequests=self.nrequests, nsynth=self.nsynth,
+                                          queued=self._queue.qsize())))
+                    continue
+                if kind == "shutdown":
+                    conn.send(("ok", None))
+                    self._stop.set()
+                    return
+                assert kind == "run_synth", kind
+                args, kwargs, priority = message[1:]
+                status, value = self.submit(args, kwargs, priority).get()
+                if status == "error":
+                    conn.send((status, value))
+                    continue
+                # Hand the spectrum over in a shared memory block; the client
+                # copies it out and says when it is done, then the block goes away
+                spectrum = np.vstack(value)
+                shm = shared_memory.SharedMemory(create=True, size=max(spectrum.nbytes, 1))
+                try:
+                    np.ndarray(spectrum.shape, dtype=spectrum.dtype, buffer=shm.buf)[:] = spectrum
+                    conn.send(("ok", (shm.name, spectrum.shape, spectrum.dtype.str)))
+                    try:
+                        conn.recv()
+                    except (EOFError, OSError):
+                        return
+                finally:
+                    shm.close()
+                    shm.unlink()
+
+def run_synth(wmin, wmax, dwl, *args, priority=0, address=None, **kwargs):
+    """
+    Same as turbopy.run_synth, but runs on the local synthesis server.
+
+    KEYWORDS:
+       priority= (0) requests with a higher priority run first
+       address= (None) the server's socket; defaults to get_default_address()
+       all other keywords are the same as run_synth
+
+    OUTPUT:
+       (wavelengths,cont-norm. spectrum, spectrum (nwave))
+    """
+    with Client(address or get_default_address(), family="AF_UNIX") as conn:
+        conn.send(("run_synth", (wmin, wmax, dwl) + tuple(args), kwargs, priority))
+        status, value = conn.recv()
+        if status == "error":
+            raise value
+        name, shape, dtype = value
+        shm = parallel._attach(name)
+        try:
+            spectrum = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            conn.send(("done",))
+    return spectrum[0], spectrum[1], spectrum[2]
+
+def get_stats(address=None):
+    """ Number of requests, syntheses run, and queued syntheses of the server """
+    with Client(address or get_default_address(), family="AF_UNIX") as conn:
+        conn.send(("stats",))
+        return conn.recv()[1]
+
+def stop_server(address=None):
+    with Client(address or get_default_address(), family="AF_UNIX") as conn:
+        conn.send(("shutdown",))
+        conn.recv()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local turbopy synthesis server")
+    parser.add_argument("--address", default=None, help="Unix socket to listen on")
+    parser.add_argument("--nproc", type=int, default=None, help="syntheses at once")
+    parser.add_argument("--workdir", default=None, help="workspace and opacity cache directory")
+    args = parser.parse_args(argv)
+    server = SynthServer(args.address, args.nproc, args.workdir)
+    sys.stdout.write(f"turbopy server listening on {server.address}\n")
+    sys.stdout.flush()
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
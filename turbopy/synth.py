@@ -1,19 +1,32 @@
 from __future__ import absolute_import, division, print_function
 
-import os, sys, shutil
+import os, sys, copy, shutil
+import hashlib
 import tempfile
 import subprocess
+import threading
 
 import numpy as np
-from .linelists import TSLineList, get_default_linelist
+from .linelists import TSLineList, get_default_linelist, get_trimmed_Hlinelists
 from .marcs import MARCSModel, interp_atmosphere
 
 from . import utils
+from . import parallel
+from . import process
+from . import cost
 
 _lpoint_max = 100000 # hardcoded into turbospectrum, we might change this
 _ERASESTR= "                                                                             "
 _TURBO_DIR_ = '/Users/iescala/Turbospectrum2019/exec-gfie-v19.1/'
 
+# Elements whose abundance can change babsma_lu's continuous opacity: the
+# continuous absorbers, the main electron donors and the elements that are
+# important in the molecular equilibrium. This is deliberately generous.
+_continuum_Zs = frozenset([1, 2, 6, 7, 8, 10, 11, 12, 13, 14, 16, 19, 20,
+                           22, 24, 25, 26, 28])
+# Elements that get the script's ALPHA/Fe (the atmosphere's AM) unless they are given individually
+_alpha_Zs = frozenset([8, 10, 12, 14, 16, 18, 20, 22])
+
 def run_synth(wmin, wmax, dwl, *args,
               linelist=None,
               atmosphere=None,
@@ -54,8 +67,9 @@ def run_synth(wmin, wmax, dwl, *args,
 
     LINELIST KEYWORDS:
           air= (True) if True, perform the synthesis in air wavelengths (affects the default Hlinelist, nothing else; output is in air if air, vacuum otherwise); set to False at your own risk, as Turbospectrum expects the linelist in air wavelengths!)
-          Hlinelist= (None) Hydrogen linelists to use; can be set to the path of a linelist file or to the name of an APOGEE linelist; if None, then we first search for the Hlinedata.vac in the APOGEE linelist directory (if air=False) or we use the internal Turbospectrum Hlinelist (if air=True)
+          Hlinelist= (None) Hydrogen linelists to use; can be set to the path of a linelist file or to the name of an APOGEE linelist; if None, then we first search for the Hlinedata.vac in the APOGEE linelist directory (if air=False) or we use the internal Turbospectrum Hlinelist (if air=True), trimmed to the lines whose wings can reach [wmin, wmax]
        linelist= (None) molecular and atomic linelists to use; can be set to the path of a linelist file or to the name of an APOGEE linelist, or lists of such files; if a single filename is given, the code will first search for files with extensions '.atoms', '.molec' or that start with 'turboatoms.' and 'turbomolec.'
+          a TSLineList can hold several source files; they are merged and deduplicated into one cached file, which is only cut to [wmin, wmax] plus a margin if the TSLineList has one
 
 
     OUTPUT:
@@ -65,29 +79,427 @@ def run_synth(wmin, wmax, dwl, *args,
 
     """
 
+    _check_npoints(wmin, wmax, dwl)
+
+    ## working directory
+    twd = _make_workspace(twd)
+
+    ## Linelist
+    linelistfilenames = _get_linelistfilenames(linelist, Hlinelist, wmin, wmax)
+    isotopes = _validate_isotopes(isotopes)
+
+    ## Stellar atmosphere
+    atmosphere = _get_atmosphere(twd, atmosphere, Teff, logg, MH, vt,
+                                 aFe, CFe, NFe, rFe, sFe)
+
+    ## Abundances
+    abundances = validate_abundances(list(args), atmosphere.MH)
+
+    modelopacname = _run_babsma(twd, wmin, wmax, dwl, atmosphere, abundances,
+                                modelopac, marcsfile, spherical, verbose)
+
+    outfilename= os.path.join(twd,'bsyn.out')
+    try:
+        _run_bsyn(twd, wmin, wmax, dwl, costheta, atmosphere, modelopacname,
+                  abundances, isotopes, linelistfilenames, outfilename,
+                  marcsfile, spherical, verbose)
+    finally:
+        if outfname is not None:
+            turbosavefilename= outfname
+            if os.path.dirname(turbosavefilename) == '':
+                turbosavefilename= os.path.join(os.getcwd(),turbosavefilename)
+            try:
+                subprocess.check_call(['tar','cvzf',turbosavefilename,
+                                       os.path.basename(os.path.normpath(twd))])
+            except subprocess.CalledProcessError:
+                raise RuntimeError("Tar-zipping the Turbospectrum input and output failed; you will have to manually delete the temporary directory ...")
+
+    # Now read the output
+    # Return wav, cont-norm, full spectrum
+    return _read_bsyn_output(outfilename)
+
+def run_synth_windows(windows, dwl, *args,
+                      halfwidth=1.0,
+                      linelist=None,
+                      atmosphere=None,
+                      Teff=None, logg=None, MH=None, vt=None,
+                      aFe=None, CFe=None, NFe=None, rFe=None, sFe=None,
+                      modelopac=None,
+                      twd=None, verbose=False,
+                      costheta=1.0, isotopes={}, marcsfile=True,
+                      spherical=False, Hlinelist=None,
+                      nproc=None,
+):
+    """
+    Run a turbospectrum synthesis only in small windows, e.g. around the lines of one element.
+
+    The windows are merged where they overlap. babsma_lu is run once over the
+    full extent of the windows and that opacity file is shared by one bsyn_lu
+    run per window; the bsyn_lu runs are done in parallel.
+
+    INPUT ARGUMENTS:
+       windows: list of line centres (each gets +/- halfwidth) and/or (wlo, whi) intervals
+       dwl: wavelength step within each window
+       lists with abundances: same as run_synth
+
+    KEYWORDS:
+       halfwidth= (1.0) half width in angstroms of the window around each line centre
+       nproc= (None) number of bsyn_lu runs at once; defaults to the number of cpus
+       all other keywords are the same as run_synth
+
+    OUTPUT:
+       WindowedSpectrum with one (wavelengths, cont-norm. spectrum, spectrum) per window
+    """
+    windows = merge_windows(windows, dwl, halfwidth=halfwidth)
+    for wlo, whi in windows:
+        _check_npoints(wlo, whi, dwl)
+    wmin, wmax = windows[0][0], windows[-1][1]
+
+    twd = _make_workspace(twd)
+    isotopes = _validate_isotopes(isotopes)
+    atmosphere = _get_atmosphere(twd, atmosphere, Teff, logg, MH, vt,
+                                 aFe, CFe, NFe, rFe, sFe)
+    abundances = validate_abundances(list(args), atmosphere.MH)
+
+    # The continuum varies slowly, so the opacity over the full extent of the
+    # windows does not need the fine step
+    modelopacname = _run_babsma(twd, wmin, wmax, _opacity_step(wmin, wmax, dwl),
+                                atmosphere, abundances,
+                                modelopac, marcsfile, spherical, verbose)
+
+    segments = [(wlo, whi, dwl) for wlo, whi in windows]
+    spectra = _run_bsyn_segments(twd, segments, costheta, atmosphere, modelopacname,
+                                 abundances, isotopes, linelist, Hlinelist,
+                                 marcsfile, spherical, verbose, nproc)
+    return WindowedSpectrum(windows, spectra)
+
+def run_synth_adaptive(wmin, wmax, dwl, *args,
+                       dwl_coarse=None, halfwidth=0.5,
+                       min_strength=-6.0, theta=1.0,
+                       outwave=None,
+                       linelist=None,
+                       atmosphere=None,
+                       Teff=None, logg=None, MH=None, vt=None,
+                       aFe=None, CFe=None, NFe=None, rFe=None, sFe=None,
+                       modelopac=None,
+                       twd=None, verbose=False,
+                       costheta=1.0, isotopes={}, marcsfile=True,
+                       spherical=False, Hlinelist=None,
+                       nproc=None,
+):
+    """
+    Run a turbospectrum synthesis with fine sampling near lines and coarse sampling elsewhere.
+
+    The lines in the linelist with strength loggf - theta*expot >= min_strength get
+    +/- halfwidth of fine sampling (step dwl); the rest of [wmin, wmax] is sampled
+    with dwl_coarse. Each sub-range is run with its own step by bsyn_lu, in parallel,
+    sharing one babsma_lu run. Since every sub-range is a separate run, the total
+    number of points is not limited by _lpoint_max.
+
+    INPUT ARGUMENTS:
+       wmin, wmax, dwl: wavelength range and the fine step
+       lists with abundances: same as run_synth
+
+    KEYWORDS:
+       dwl_coarse= (10*dwl) step away from lines
+       halfwidth= (0.5) half width in angstroms of the fine sampling around each line
+       min_strength= (-6.0) lines weaker than this do not get fine sampling
+       theta= (1.0) 5040/T used for the line strength
+       outwave= (None) if given, resample the spectrum onto these wavelengths
+       nproc= (None) number of bsyn_lu runs at once; defaults to the number of cpus
+       all other keywords are the same as run_synth
+
+    OUTPUT:
+       (wavelengths,cont-norm. spectrum, spectrum (nwave)) on the non-uniform grid,
+       or on outwave if given
+    """
+    if dwl_coarse is None: dwl_coarse = 10*dwl
+    assert dwl_coarse >= dwl, (dwl, dwl_coarse)
+    if linelist is None:
+        linelist = get_default_linelist(wmin, wmax)
+    assert isinstance(linelist, TSLineList)
+    waves, expots, loggfs = linelist.get_lines(wmin - halfwidth, wmax + halfwidth)
+    strong = loggfs - theta*expots >= min_strength
+    segments = adaptive_segments(wmin, wmax, dwl, dwl_coarse, waves[strong], halfwidth)
+
+    twd = _make_workspace(twd)
+    isotopes = _validate_isotopes(isotopes)
+    atmosphere = _get_atmosphere(twd, atmosphere, Teff, logg, MH, vt,
+                                 aFe, CFe, NFe, rFe, sFe)
+    abundances = validate_abundances(list(args), atmosphere.MH)
+    modelopacname = _run_babsma(twd, wmin, wmax, _opacity_step(wmin, wmax, dwl),
+                                atmosphere, abundances,
+                                modelopac, marcsfile, spherical, verbose)
+    spectra = _run_bsyn_segments(twd, segments, costheta, atmosphere, modelopacname,
+                                 abundances, isotopes, linelist, Hlinelist,
+                                 marcsfile, spherical, verbose, nproc)
+    wave, norm, flux = _merge_segments(spectra)
+    if outwave is not None:
+        outwave = np.asarray(outwave)
+        return outwave, np.interp(outwave, wave, norm), np.interp(outwave, wave, flux)
+    return wave, norm, flux
+
+def adaptive_segments(wmin, wmax, dwl, dwl_coarse, linewaves, halfwidth=0.5):
+    """
+    Split [wmin, wmax] into (wlo, whi, step) segments: step dwl within halfwidth of
+    linewaves, dwl_coarse elsewhere. Coarse gaps shorter than a few coarse steps are
+    sampled finely instead, and no segment has more than _lpoint_max points.
+    """
+    fine = []
+    if len(linewaves) > 0:
+        for wlo, whi in merge_windows(linewaves, dwl, halfwidth=halfwidth):
+            wlo, whi = max(wlo, wmin), min(whi, wmax)
+            if wlo < whi: fine.append([wlo, whi])
+    # Fill in gaps that are too short to bother with
+    mingap = 5*dwl_coarse
+    merged = []
+    for wlo, whi in fine:
+        if len(merged) > 0 and wlo - merged[-1][1] < mingap:
+            merged[-1][1] = whi
+        else:
+            merged.append([wlo, whi])
+    if len(merged) > 0 and merged[0][0] - wmin < mingap: merged[0][0] = wmin
+    if len(merged) > 0 and wmax - merged[-1][1] < mingap: merged[-1][1] = wmax
+    segments = []
+    w = wmin
+    for wlo, whi in merged:
+        if wlo > w: segments.append((w, wlo, dwl_coarse))
+        segments.append((wlo, whi, dwl))
+        w = whi
+    if w < wmax: segments.append((w, wmax, dwl_coarse))
+    # Respect the Turbospectrum limit on the number of points per run
+    split_segments = []
+    for wlo, whi, step in segments:
+        nsplit = int(np.ceil((whi - wlo)/step/_lpoint_max))
+        edges = wlo + (whi - wlo)*np.arange(nsplit+1)/nsplit
+        edges = np.round(edges/step)*step
+        edges[0], edges[-1] = wlo, whi
+        split_segments += [(float(a), float(b), step) for a, b in zip(edges[:-1], edges[1:])]
+    return split_segments
+
+def _merge_segments(spectra):
+    """ Concatenate the spectra of adjacent segments, dropping repeated edge points """
+    waves, norms, fluxes = [], [], []
+    wlast = -np.inf
+    for wave, norm, flux in spectra:
+        keep = wave > wlast + 1e-6
+        waves.append(wave[keep]); norms.append(norm[keep]); fluxes.append(flux[keep])
+        if keep.any(): wlast = wave[keep][-1]
+    return np.concatenate(waves), np.concatenate(norms), np.concatenate(fluxes)
+
+def run_synth_intensities(wmin, wmax, dwl, *args,
+                          mus=[1.0],
+                          linelist=None,
+                          atmosphere=None,
+                          Teff=None, logg=None, MH=None, vt=None,
+                          aFe=None, CFe=None, NFe=None, rFe=None, sFe=None,
+                          modelopac=None,
+                          twd=None, verbose=False,
+                          isotopes={}, marcsfile=True,
+                          spherical=False, Hlinelist=None,
+                          nproc=None,
+):
+    """
+    Run a turbospectrum synthesis of the specific intensity at several viewing angles,
+    e.g. for limb darkening or disk integration.
+
+    babsma_lu is run once and the bsyn_lu intensity runs for all angles share
+    its opacity file; the bsyn_lu runs are done in parallel.
+
+    INPUT ARGUMENTS:
+       wmin, wmax, dwl, lists with abundances: same as run_synth
+
+    KEYWORDS:
+       mus= ([1.0]) list of mu = cos(theta) values
+       nproc= (None) number of bsyn_lu runs at once; defaults to the number of cpus
+       all other keywords are the same as run_synth
+
+    OUTPUT:
+       (wavelengths (nwave), cont-norm. intensity (nmu, nwave), intensity (nmu, nwave))
+    """
+    _check_npoints(wmin, wmax, dwl)
+    mus = np.atleast_1d(mus).astype(float)
+    assert len(mus) > 0, mus
+    assert np.all((mus > 0) & (mus <= 1)), mus
+
+    twd = _make_workspace(twd)
+    linelistfilenames = _get_linelistfilenames(linelist, Hlinelist, wmin, wmax)
+    isotopes = _validate_isotopes(isotopes)
+    atmosphere = _get_atmosphere(twd, atmosphere, Teff, logg, MH, vt,
+                                 aFe, CFe, NFe, rFe, sFe)
+    abundances = validate_abundances(list(args), atmosphere.MH)
+    modelopacname = _run_babsma(twd, wmin, wmax, dwl, atmosphere, abundances,
+                                modelopac, marcsfile, spherical, verbose)
+
+    def _synth_angle(i, mu):
+        mtwd = _make_workspace(os.path.join(twd, f"mu{i:03}"))
+        outfilename = os.path.join(mtwd, 'bsyn.out')
+        _run_bsyn(mtwd, wmin, wmax, dwl, mu, atmosphere, modelopacname,
+                  abundances, isotopes, linelistfilenames, outfilename,
+                  marcsfile, spherical, verbose, intensity=True)
+        return _read_bsyn_output(outfilename)
+    spectra = parallel.map_jobs(_synth_angle, enumerate(mus), nproc=nproc)
+    wave = spectra[0][0]
+    norm = np.vstack([spec[1] for spec in spectra])
+    intensity = np.vstack([spec[2] for spec in spectra])
+    return wave, norm, intensity
+
+def merge_windows(windows, dwl, halfwidth=1.0):
+    """
+    Turn a list of line centres and/or (wlo, whi) intervals into sorted,
+    non-overlapping intervals whose edges fall on multiples of dwl
+    """
+    intervals = []
+    for window in windows:
+        if np.ndim(window) == 0:
+            wlo, whi = window - halfwidth, window + halfwidth
+        else:
+            wlo, whi = window
+        assert wlo < whi, (wlo, whi)
+        intervals.append((np.floor(wlo/dwl)*dwl, np.ceil(whi/dwl)*dwl))
+    assert len(intervals) > 0, "Need at least one window"
+    intervals.sort()
+    merged = [list(intervals[0])]
+    for wlo, whi in intervals[1:]:
+        if wlo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], whi)
+        else:
+            merged.append([wlo, whi])
+    return [(float(wlo), float(whi)) for wlo, whi in merged]
+
+class WindowedSpectrum(object):
+    """
+    A spectrum that is only synthesized in a set of disjoint wavelength windows.
+    Iterating gives (wave, norm, flux) for each window;
+    wave, norm, flux give all windows concatenated.
+    """
+    def __init__(self, windows, spectra):
+        super(WindowedSpectrum, self).__init__()
+        assert len(windows) == len(spectra)
+        self.windows = list(windows)
+        self.spectra = list(spectra)
+
+    def __len__(self):
+        return len(self.windows)
+    def __iter__(self):
+        return iter(self.spectra)
+    def __getitem__(self, i):
+        return self.spectra[i]
+
+    @property
+    def wave(self):
+        return np.concatenate([spec[0] for spec in self.spectra])
+    @property
+    def norm(self):
+        return np.concatenate([spec[1] for spec in self.spectra])
+    @property
+    def flux(self):
+        return np.concatenate([spec[2] for spec in self.spectra])
+    @property
+    def npoints(self):
+        return sum(len(spec[0]) for spec in self.spectra)
+
+def affects_continuum(Z_or_elem):
+    """
+    Whether changing this element's abundance can change the continuous opacity.
+    If not, syntheses that only differ in this element can share one babsma_lu run.
+    """
+    if isinstance(Z_or_elem, str): Z_or_elem = utils.elem_to_Z(Z_or_elem)
+    return int(Z_or_elem) in _continuum_Zs
+
+def get_XFe(args, Z, AM):
+    """
+    [X/Fe] of element Z in a synthesis with abundances args = [(Z, XFe), ...]:
+    its value in args if it is there, else AM for alpha elements and 0 for the others
+    """
+    for Z1, XFe in args:
+        if int(Z1) == Z: return float(XFe)
+    return float(AM) if Z in _alpha_Zs else 0.0
+
+def opacity_key(wmin, wmax, dwl, args, atmosphere, vt, marcsfile=True, spherical=False):
+    """
+    Hash of the inputs that babsma_lu's opacity file depends on: syntheses with the
+    same key can share one opacity file (e.g. through run_synth's modelopac keyword).
+    Only the abundances of elements that affect the continuum are included.
+    Returns None if the atmosphere is not a MARCS model file with MH and AM set.
+    """
+    if isinstance(atmosphere, str):
+        try:
+            atmosphere = MARCSModel.load(atmosphere)
+        except AssertionError:
+            return None
+    if not isinstance(atmosphere, MARCSModel) or atmosphere.get_fname() is None:
+        return None
+    try:
+        MH, AM = atmosphere.MH, atmosphere.AM
+    except AttributeError:
+        return None
+    fname = os.path.abspath(atmosphere.get_fname())
+    stat = os.stat(fname)
+    abundances = validate_abundances([tuple(x) for x in args], MH)
+    continuum_abundances = sorted((Z, XH) for Z, XH in abundances.items() if affects_continuum(Z))
+    key = (f"{fname}|{stat.st_mtime_ns}|{stat.st_size}|{MH:.3f}|{AM:.3f}|{vt:.3f}|"
+           f"{wmin:.3f}|{wmax:.3f}|{dwl:.3f}|{marcsfile}|{spherical}|{continuum_abundances}")
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+def _run_shared_babsma(twd, args, kwargs, modelopac=None):
+    """
+    babsma_lu for a synthesis with run_synth arguments (args, kwargs) whose opacity
+    can be shared (see opacity_key), in the workspace twd. If modelopac is given the
+    opacity is also stored there. Returns the name of the opacity file.
+    """
+    twd = _make_workspace(twd)
+    atmosphere = _get_atmosphere(twd, kwargs.get("atmosphere"),
+                                 None, None, None, kwargs.get("vt"),
+                                 None, None, None, None, None)
+    abundances = validate_abundances(list(args[3:]), atmosphere.MH)
+    return _run_babsma(twd, args[0], args[1], args[2], atmosphere, abundances,
+                       modelopac, kwargs.get("marcsfile", True),
+                       kwargs.get("spherical", False), kwargs.get("verbose", False))
+
+def _check_npoints(wmin, wmax, dwl):
     Nwl = np.ceil((wmax-wmin)/dwl)
     if Nwl > _lpoint_max:
         raise ValueError(f"Trying to synthesize {Nwl} > {_lpoint_max} wavelength points")
 
-    ## working directory
+def _opacity_step(wmin, wmax, dwl):
+    """ Smallest step >= dwl that keeps a babsma_lu run over [wmin, wmax] within _lpoint_max """
+    # the scripts write the step with 3 decimals, so round up to that
+    return max(dwl, np.ceil(1000*(wmax-wmin)/_lpoint_max)/1000)
+
+def _make_workspace(twd=None):
+    """ Create the working directory (if needed) and link the Turbospectrum DATA directory """
     if twd is None:
         twd = tempfile.mkdtemp(dir=os.getcwd()+"/tmp")
+    elif not os.path.exists(twd):
+        os.makedirs(twd)
+    twd = os.path.abspath(twd)
+    if not os.path.exists(os.path.join(twd, 'DATA')):
+        os.symlink(os.getenv('TURBODATA'),os.path.join(twd,'DATA'))
+    return twd
 
-    ## Linelist
+def _get_linelistfilenames(linelist, Hlinelist, wmin, wmax):
+    return _get_segment_linelistfilenames(linelist, Hlinelist, [(wmin, wmax)])[0]
+
+def _get_segment_linelistfilenames(linelist, Hlinelist, windows):
+    """
+    The linelist files for bsyn_lu for each (wmin, wmax) of windows. Every source
+    linelist is read at most once, however many windows there are.
+    """
     if linelist is None:
-        linelist = get_default_linelist(wmin, wmax)
+        linelist = get_default_linelist(min([w[0] for w in windows]), max([w[1] for w in windows]))
     else:
         assert isinstance(linelist, TSLineList)
-    linelistfilenames = [linelist.get_fname()]
-    rmLinelists = False
-    # Link the Turbospectrum DATA directory
-    if not os.path.exists(os.path.join(twd, 'DATA')):
-        os.symlink(os.getenv('TURBODATA'),os.path.join(twd,'DATA'))
-
+    linelistfilenames = linelist.get_fnames(windows)
     if Hlinelist is None:
-        Hlinelist = 'DATA/Hlinedata'
-    linelistfilenames.append(Hlinelist)
+        # Only the hydrogen lines that can reach each window
+        Hlinelists = get_trimmed_Hlinelists(windows)
+    else:
+        Hlinelists = [Hlinelist]*len(windows)
+    return [[fname for fname in fnames if fname is not None]
+            for fnames in zip(linelistfilenames, Hlinelists)]
 
+def _validate_isotopes(isotopes):
     if isinstance(isotopes,str) and isotopes.lower() == 'solar':
         isotopes= {}
     elif isinstance(isotopes,str) and isotopes.lower() == 'arcturus':
@@ -95,17 +507,20 @@ def run_synth(wmin, wmax, dwl, *args,
                    '6.013':'0.0625'}
     elif not isinstance(isotopes,dict):
         raise ValueError("'isotopes=' input not understood, should be 'solar', 'arcturus', or a dictionary")
+    return isotopes
 
-    ## Stellar atmosphere
+def _get_atmosphere(twd, atmosphere, Teff, logg, MH, vt,
+                    aFe, CFe, NFe, rFe, sFe):
     if atmosphere is not None:
         # The MARCS models need you to set vt separately
         assert vt is not None, vt
         if isinstance(atmosphere, str):
             atmosphere = MARCSModel.load(atmosphere)
         assert isinstance(atmosphere, MARCSModel)
+        # A copy, since syntheses running at the same time can share one model
+        # object with different vt
+        atmosphere = copy.copy(atmosphere)
         atmosphere.vt = vt
-        Teff, logg, MH, aFe = atmosphere.Teff, atmosphere.logg, \
-            atmosphere.MH, atmosphere.AM
     else:
         assert Teff is not None, Teff
         assert logg is not None, logg
@@ -114,11 +529,30 @@ def run_synth(wmin, wmax, dwl, *args,
         atmosphere = interp_atmosphere(Teff, logg, MH, vt,
                                        aFe, CFe, NFe, rFe, sFe)
         atmosphere.writeto(os.path.join(twd, 'atm.mod'))
-    modelfilename = atmosphere.get_fname()
+    return atmosphere
 
-    ## Abundances
-    abundances = validate_abundances(list(args), atmosphere.MH)
+def _run_turbospectrum(program, twd, parfilename, verbose, outfiles=[]):
+    """
+    Run babsma_lu or bsyn_lu in twd, feeding it the script file parfilename.
+    The run is supervised by process.run_program (timeouts, limits, retries);
+    a failure raises process.TurbospectrumError.
+    Returns the wall time of the run in seconds.
+    """
+    sys.stdout.write('\r'+f"Running Turbospectrum {program} ...\r")
+    sys.stdout.flush()
+    try:
+        return process.run_program(os.path.join(_TURBO_DIR_, program), twd, parfilename,
+                                   verbose=verbose, outfiles=outfiles)
+    finally:
+        sys.stdout.write('\r'+_ERASESTR+'\r')
+        sys.stdout.flush()
 
+def _run_babsma(twd, wmin, wmax, dwl, atmosphere, abundances,
+                modelopac, marcsfile, spherical, verbose):
+    """
+    Compute the continuous opacity with babsma_lu, or reuse modelopac if it exists.
+    Returns the name of the opacity file to give to bsyn_lu.
+    """
     if modelopac is None or \
             (isinstance(modelopac,str) and not os.path.exists(modelopac)):
         # Now write the script file for babsma_lu
@@ -127,7 +561,7 @@ def run_synth(wmin, wmax, dwl, *args,
         _write_script(scriptfilename,
                       wmin,wmax,dwl,
                       None,
-                      modelfilename,
+                      atmosphere.get_fname(),
                       marcsfile,
                       modelopacname,
                       atmosphere.MH,
@@ -136,50 +570,49 @@ def run_synth(wmin, wmax, dwl, *args,
                       atmosphere.vt,
                       spherical,
                       None,None,None,bsyn=False)
-        # Run babsma
-        sys.stdout.write('\r'+"Running Turbospectrum babsma_lu ...\r")
-        sys.stdout.flush()
-        if verbose:
-            stdout= None
-            stderr= None
-        else:
-            stdout= open('/dev/null', 'w')
-            stderr= subprocess.STDOUT
-        try:
-            p= subprocess.Popen([os.path.join(_TURBO_DIR_, 'babsma_lu')],
-                                cwd=twd,
-                                stdin=subprocess.PIPE,
-                                stdout=stdout,
-                                stderr=stderr)
-            with open(os.path.join(twd,'babsma.par'),'r') as parfile:
-                for line in parfile:
-                    p.stdin.write(line.encode('utf-8'))
-            stdout, stderr= p.communicate()
-        except subprocess.CalledProcessError:
-            for linelistfilename in linelistfilenames:
-                os.remove(linelistfilename,twd)
-            if os.path.exists(os.path.join(twd,'DATA')):
-                os.remove(os.path.join(twd,'DATA'))
-            raise RuntimeError("Running babsma_lu failed ...")
-        finally:
-            #if os.path.exists(os.path.join(twd,'babsma.par')) \
-            #   and outfname is None: #not 'saveTurboInput' in kwargs:
-            #    os.remove(os.path.join(twd,'babsma.par'))
-            sys.stdout.write('\r'+_ERASESTR+'\r')
-            sys.stdout.flush()
+        seconds = _run_turbospectrum('babsma_lu', twd, scriptfilename, verbose,
+                                     outfiles=[modelopacname])
+        cost.record_timing('babsma_lu', cost.get_npoints(wmin, wmax, dwl), 0, spherical, seconds)
         if isinstance(modelopac,str):
-            shutil.copy(modelopacname,modelopac)
+            # Copy then rename, so nobody else sees a partial opacity file
+            tmpmodelopac = f"{modelopac}.{os.getpid()}.{threading.get_ident()}"
+            shutil.copy(modelopacname,tmpmodelopac)
+            os.replace(tmpmodelopac,modelopac)
     else:
         shutil.copy(modelopac,twd)
         modelopacname= os.path.join(twd,os.path.basename(modelopac))
+    return modelopacname
 
-    # Now write the script file for bsyn_lu
+def _run_bsyn_segments(twd, segments, costheta, atmosphere, modelopacname,
+                       abundances, isotopes, linelist, Hlinelist,
+                       marcsfile, spherical, verbose, nproc):
+    """
+    Run bsyn_lu for each (wlo, whi, step) segment in its own sub-workspace, in parallel,
+    all with the same opacity file. Returns the spectra in the order of segments.
+    """
+    def _synth_segment(i, wlo, whi, step, linelistfilenames):
+        stwd = _make_workspace(os.path.join(twd, f"window{i:04}"))
+        outfilename = os.path.join(stwd, 'bsyn.out')
+        _run_bsyn(stwd, wlo, whi, step, costheta, atmosphere, modelopacname,
+                  abundances, isotopes, linelistfilenames, outfilename,
+                  marcsfile, spherical, verbose)
+        return _read_bsyn_output(outfilename)
+    # All the linelist files up front, so the big linelists are read only once
+    linelistfilenames = _get_segment_linelistfilenames(linelist, Hlinelist,
+                                                       [(wlo, whi) for wlo, whi, step in segments])
+    jobs = [(i,) + tuple(segment) + (fnames,)
+            for i, (segment, fnames) in enumerate(zip(segments, linelistfilenames))]
+    return parallel.map_jobs(_synth_segment, jobs, nproc=nproc)
+
+def _run_bsyn(twd, wmin, wmax, dwl, costheta, atmosphere, modelopacname,
+              abundances, isotopes, linelistfilenames, outfilename,
+              marcsfile, spherical, verbose, intensity=False):
+    """ Write the script file for bsyn_lu and run it in twd """
     scriptfilename= os.path.join(twd,'bsyn.par')
-    outfilename= os.path.join(twd,'bsyn.out')
     _write_script(scriptfilename,
                   wmin,wmax,dwl,
                   costheta,
-                  modelfilename,
+                  atmosphere.get_fname(),
                   marcsfile,
                   modelopacname,
                   atmosphere.MH,
@@ -190,65 +623,17 @@ def run_synth(wmin, wmax, dwl, *args,
                   outfilename,
                   isotopes,
                   linelistfilenames,
-                  bsyn=True)
-    # Run bsyn
-    sys.stdout.write('\r'+"Running Turbospectrum bsyn_lu ...\r")
-    sys.stdout.flush()
-    if verbose:
-        stdout= None
-        stderr= None
-    else:
-        stdout= open('/dev/null', 'w')
-        stderr= subprocess.STDOUT
-    try:
-        p= subprocess.Popen([os.path.join(_TURBO_DIR_, 'bsyn_lu')],
-                            cwd=twd,
-                            stdin=subprocess.PIPE,
-                            stdout=stdout,
-                            stderr=stderr)
-        with open(os.path.join(twd,'bsyn.par'),'r') as parfile:
-            for line in parfile:
-                p.stdin.write(line.encode('utf-8'))
-        stdout, stderr= p.communicate()
-    except subprocess.CalledProcessError:
-        raise RuntimeError("Running bsyn_lu failed ...")
-    finally:
-        if outfname is not None:
-            turbosavefilename= outfname
-            if os.path.dirname(turbosavefilename) == '':
-                turbosavefilename= os.path.join(os.getcwd(),turbosavefilename)
-            try:
-                subprocess.check_call(['tar','cvzf',turbosavefilename,
-                                       os.path.basename(os.path.normpath(twd))])
-            except subprocess.CalledProcessError:
-                raise RuntimeError("Tar-zipping the Turbospectrum input and output failed; you will have to manually delete the temporary directory ...")
-        #    # Need to remove babsma.par, bc not removed above
-        #    if os.path.exists(os.path.join(twd,'babsma.par')):
-        #        os.remove(os.path.join(twd,'babsma.par'))
-        #if os.path.exists(os.path.join(twd,'bsyn.par')):
-        #    os.remove(os.path.join(twd,'bsyn.par'))
-        #if os.path.exists(modelopacname):
-        #    os.remove(modelopacname)
-        #if os.path.exists(modelopacname+'.mod'):
-        #    os.remove(modelopacname+'.mod')
-        #if os.path.exists(os.path.join(twd,'DATA')):
-        #    os.remove(os.path.join(twd,'DATA'))
-        #if os.path.exists(os.path.join(twd,'dummy-output.dat')):
-        #    os.remove(os.path.join(twd,'dummy-output.dat'))
-        #if os.path.exists(modelfilename):
-        #    os.remove(modelfilename)
-        #if rmLinelists:
-        #    for linelistfilename in linelistfilenames[1:]:
-        #        os.remove(linelistfilename)
-        sys.stdout.write('\r'+_ERASESTR+'\r')
-        sys.stdout.flush()
+                  bsyn=True,
+                  intensity=intensity)
+    seconds = _run_turbospectrum('bsyn_lu', twd, scriptfilename, verbose,
+                                 outfiles=[outfilename])
+    cost.record_timing('bsyn_lu', cost.get_npoints(wmin, wmax, dwl),
+                       cost.linelist_bytes(linelistfilenames), spherical, seconds)
+    return outfilename
 
-    # Now read the output
+def _read_bsyn_output(outfilename):
+    """ Returns wav, cont-norm, full spectrum """
     turboOut= np.loadtxt(outfilename)
-    # Clean up
-    #os.remove(outfilename)
-    #os.rmdir(twd)
-    # Return wav, cont-norm, full spectrum
     return (turboOut[:,0],turboOut[:,1],turboOut[:,2])
 
 def validate_abundances(abundances, MH):
@@ -290,14 +675,18 @@ def _write_script(scriptfilename,
                   resultfilename,
                   isotopes,
                   linelistfilenames,
-                  bsyn=False):
+                  bsyn=False,
+                  intensity=False):
     """Write the script file for babsma and bsyn"""
     with open(scriptfilename,'w') as scriptfile:
         scriptfile.write("'LAMBDA_MIN:'  '%.3f'\n" % wmin)
         scriptfile.write("'LAMBDA_MAX:'  '%.3f'\n" % wmax)
         scriptfile.write("'LAMBDA_STEP:' '%.3f'\n" % dw)
         if bsyn:
-            scriptfile.write("'INTENSITY/FLUX:' 'Flux'\n")
+            if intensity:
+                scriptfile.write("'INTENSITY/FLUX:' 'Intensity'\n")
+            else:
+                scriptfile.write("'INTENSITY/FLUX:' 'Flux'\n")
             scriptfile.write("'COS(THETA)    :' '%.3f'\n" % costheta)
             scriptfile.write("'ABFIND        :' '.false.'\n")
         if not bsyn:
@@ -0,0 +1,188 @@
+from __future__ import absolute_import, division, print_function
+import os
+import threading
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+import numpy as np
+import numpy.testing as npt
+import turbopy
+from turbopy import batch
+
+data_path = os.path.join(turbopy.__path__[0], 'data')
+
+def _sun():
+    atmo = turbopy.MARCSModel.load(os.path.join(data_path, "sun.mod"))
+    atmo.Teff = 5777
+    atmo.logg = 4.44
+    atmo.MH = 0.0
+    atmo.AM = 0.0
+    return atmo
+
+def _specs():
+    atmo = _sun()
+    specs = []
+    # Trace elements only change bsyn_lu, Mg changes the continuum
+    for BaFe in [-0.5, 0.0, 0.5]:
+        for MgFe in [0.0, 0.4]:
+            specs.append(batch.synth_spec(6700, 6720, 0.01, [56, BaFe], [12, MgFe],
+                                          atmosphere=atmo, vt=1.0))
+    # Different vt needs its own opacity
+    specs.append(batch.synth_spec(6700, 6720, 0.01, [56, 0.0], atmosphere=atmo, vt=2.0))
+    # No MARCS model to key on
+    specs.append(batch.synth_spec(6700, 6720, 0.01, Teff=5000, logg=2.0, MH=-1.0, vt=1.5))
+    return specs
+
+def test_plan_batch():
+    plan = batch.plan_batch(_specs())
+    groups = [jobs for key, jobs in plan.groups]
+    assert groups == [[0, 2, 4], [1, 3, 5], [6], [7]]
+    assert plan.groups[3][0] is None
+    report = plan.report()
+    assert report["njobs"] == 8
+    assert report["nbabsma"] == 4
+    npt.assert_almost_equal(report["dedup_ratio"], 2.0)
+
+def test_run_batch(tmp_path, monkeypatch):
+    """ Check the DAG with fake stages, so Turbospectrum is not needed """
+    # Nothing should be written outside workdir, e.g. no linelist cache
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("TURBOPY_CACHE", raising=False)
+    lock = threading.Lock()
+    opacities = []
+    def fake_run_babsma(twd, wmin, wmax, dwl, atmosphere, abundances, *args):
+        fname = os.path.join(twd, "mopac")
+        open(fname, "w").close()
+        with lock: opacities.append(fname)
+        return fname
+    def fake_run_synth(wmin, wmax, dwl, *args, modelopac=None, **kwargs):
+        if modelopac is not None:
+            assert os.path.exists(modelopac)
+        wave = np.arange(wmin, wmax, dwl)
+        return wave, np.ones_like(wave), modelopac
+    monkeypatch.setattr(turbopy.synth, "_run_babsma", fake_run_babsma)
+    monkeypatch.setattr(turbopy.synth, "_make_workspace", lambda twd: os.makedirs(twd) or twd)
+    monkeypatch.setattr(turbopy.synth, "run_synth", fake_run_synth)
+    results, report = batch.run_batch(_specs(), nproc=3, workdir=str(tmp_path))
+    assert len(opacities) == 3
+    assert len(results) == 8
+    assert results[0][2] == results[2][2] == results[4][2]
+    assert results[1][2] == results[3][2] == results[5][2]
+    assert results[0][2] != results[1][2]
+    assert results[7][2] is None
+    assert report["nbabsma"] == 4
+    assert not (tmp_path / "tmp").exists()
+
+def test_run_batch_shared_model_vt(tmp_path, monkeypatch):
+    """ Jobs running at the same time on one model object each get their own vt """
+    import time
+    def fake_run_babsma(twd, wmin, wmax, dwl, atmosphere, abundances, *args):
+        fname = os.path.join(twd, "mopac")
+        open(fname, "w").close()
+        return fname
+    def fake_run_bsyn(twd, wmin, wmax, dwl, costheta, atmosphere, modelopacname,
+                      abundances, isotopes, linelistfilenames, outfilename, *args):
+        # Give the other jobs time to set up their atmospheres
+        time.sleep(0.2)
+        with open(outfilename, "w") as fp:
+            fp.write(str(atmosphere.vt))
+        return outfilename
+    def fake_read_bsyn_output(outfilename):
+        with open(outfilename) as fp:
+            vt = float(fp.read())
+        return np.zeros(1), np.ones(1), np.full(1, vt)
+    monkeypatch.setattr(turbopy.synth, "_run_babsma", fake_run_babsma)
+    monkeypatch.setattr(turbopy.synth, "_run_bsyn", fake_run_bsyn)
+    monkeypatch.setattr(turbopy.synth, "_read_bsyn_output", fake_read_bsyn_output)
+    monkeypatch.setattr(turbopy.synth, "_get_linelistfilenames", lambda *args: [])
+    monkeypatch.setattr(turbopy.synth, "_make_workspace",
+                        lambda twd: os.makedirs(twd, exist_ok=True) or twd)
+    atmo = _sun()
+    vts = [1.0, 2.0, 1.0, 2.0]
+    specs = [batch.synth_spec(6700, 6720, 0.01, [56, 0.1*i], atmosphere=atmo, vt=vt)
+             for i, vt in enumerate(vts)]
+    results, report = batch.run_batch(specs, nproc=4, workdir=str(tmp_path))
+    assert [float(flux[0]) for wave, norm, flux in results] == vts
+    assert not hasattr(atmo, "vt")
+
+def test_run_batch_process(tmp_path, monkeypatch):
+    """ The process backend hands the spectra back through shared memory """
+    pytest.importorskip("multiprocessing.shared_memory")
+    # The fakes below only reach the workers if they are forked from this process
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("needs the fork start method")
+    monkeypatch.setattr(batch, "ProcessPoolExecutor",
+                        functools.partial(ProcessPoolExecutor,
+                                          mp_context=multiprocessing.get_context("fork")))
+    def fake_run_babsma(twd, wmin, wmax, dwl, atmosphere, abundances, *args):
+        fname = os.path.join(twd, "mopac")
+        open(fname, "w").close()
+        return fname
+    def fake_run_synth(wmin, wmax, dwl, *args, modelopac=None, vt=1.0, **kwargs):
+        wave = np.arange(wmin, wmax, dwl)
+        return wave, np.ones_like(wave), np.full_like(wave, vt)
+    monkeypatch.setattr(turbopy.synth, "_run_babsma", fake_run_babsma)
+    monkeypatch.setattr(turbopy.synth, "_make_workspace", lambda twd: os.makedirs(twd) or twd)
+    monkeypatch.setattr(turbopy.synth, "run_synth", fake_run_synth)
+    results, report = batch.run_batch(_specs(), nproc=2, workdir=str(tmp_path), backend="process")
+    with results:
+        assert len(results) == 8
+        for i, (wave, norm, flux) in enumerate(results):
+            npt.assert_allclose(wave, np.arange(6700, 6720, 0.01))
+            npt.assert_equal(norm, 1.0)
+        npt.assert_equal(results[6][2], 2.0)
+        npt.assert_equal(results[7][2], 1.5)
+
+def test_capacities():
+    atmo = _sun()
+    plan = batch.plan_batch([batch.synth_spec(6700, 6710, 0.0124, atmosphere=atmo, vt=1.0),
+                             batch.synth_spec(6700, 6710, 0.01, atmosphere=atmo, vt=1.0)])
+    # Turbospectrum runs at the 3 decimal step, 0.012
+    assert plan.capacities()[0] >= len(np.arange(6700, 6710 + 1e-6, 0.012))
+    assert plan.capacities()[1] >= 1001
+    assert turbopy.cost.get_npoints(6700, 6710, 0.01) == 1001
+    assert turbopy.cost.get_npoints(6700, 6710, 0.0124) == 834
+
+def test_schedule_and_dry_run():
+    # bsyn_lu only depends on npoints, babsma_lu costs 1 s
+    records = [dict(program="bsyn_lu", npoints=n, nbytes=0, spherical=False, seconds=n/1000.)
+               for n in [1000, 10000, 100000]]*20
+    records += [dict(program="babsma_lu", npoints=n, nbytes=0, spherical=False, seconds=1.0)
+                for n in [1000, 10000, 100000]]*20
+    model = turbopy.CostModel(records)
+    atmo = _sun()
+    # One opacity group per window: 2 x 1 s, 2 x 10 s, 2 x 0.1 s and a 100 s job
+    specs = [batch.synth_spec(6700, 6700+width, 0.01, [56, BaFe], atmosphere=atmo, vt=1.0,
+                              Hlinelist="none")
+             for width in [10, 100, 1] for BaFe in [0.0, 0.5]]
+    specs.append(batch.synth_spec(6700, 7700, 0.01, atmosphere=atmo, vt=1.0, Hlinelist="none"))
+    plan = batch.plan_batch(specs)
+    initial, children, seconds, work = plan.schedule(model)
+    assert initial == [("opacity", i) for i in range(4)]
+    assert children[("opacity", 1)] == [("job", 2), ("job", 3)]
+    npt.assert_allclose(seconds[("job", 6)], 100.0, rtol=0.05)
+    npt.assert_allclose(work[("opacity", 3)], 101.0, rtol=0.05)
+    # The biggest group goes first
+    assert batch._ReadyQueue(work, initial).pop() == ("opacity", 3)
+    report = plan.dry_run(nproc=2, model=model)
+    npt.assert_allclose(report["serial_time"], 4 + 100 + 2*(10 + 1 + 0.1), rtol=0.05)
+    npt.assert_allclose(report["core_hours"], report["serial_time"]/3600)
+    # The big job runs on one worker, everything else fits on the other
+    npt.assert_allclose(report["wall_time"], 101.0, rtol=0.05)
+    npt.assert_allclose(batch.dry_run(specs, nproc=1, model=model)["wall_time"],
+                        report["serial_time"])
+
+def test_dry_run_is_cheap(tmp_path, monkeypatch):
+    """ Planning does not read or trim linelists """
+    monkeypatch.setenv("TURBOPY_CACHE", str(tmp_path / "cache"))
+    def no_read(fname):
+        raise AssertionError(f"Read {fname}")
+    monkeypatch.setattr(turbopy.linelists, "read_turbospectrum_blocks", no_read)
+    ll = turbopy.TSLineList(os.path.join(data_path, "vald-6700-6720.list"), margin=1.0)
+    atmo = _sun()
+    specs = [batch.synth_spec(6700+i, 6702+i, 0.01, atmosphere=atmo, vt=1.0, linelist=ll)
+             for i in range(5)]
+    report = batch.dry_run(specs, nproc=2, model=turbopy.CostModel([]))
+    assert report["wall_time"] > 0
+    assert not (tmp_path / "cache").exists()
@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function
+import os
+import numpy as np
+import numpy.testing as npt
+from turbopy import cost
+
+def test_record_timings(tmp_path):
+    fname = str(tmp_path / "timings.jsonl")
+    cost.record_timing("bsyn_lu", 1000, 2e6, False, 3.5, fname=fname)
+    cost.record_timing("babsma_lu", 1000, 0, True, 0.5, fname=fname)
+    with open(fname, "a") as fp:
+        fp.write('{"program": "bsyn_lu", "npo') # a partial line
+    records = cost.read_timings(fname)
+    assert len(records) == 2
+    assert records[0] == dict(program="bsyn_lu", npoints=1000, nbytes=2000000,
+                              spherical=False, seconds=3.5)
+    assert records[1]["spherical"]
+
+def test_cost_model():
+    # No timings: the defaults, bigger jobs cost more
+    model = cost.CostModel([])
+    assert model.nrecords["bsyn_lu"] == 0
+    seconds = model.predict("bsyn_lu", [1000, 10000, 10000], [1e6, 1e6, 1e7])
+    assert seconds[0] < seconds[1] < seconds[2]
+    assert model.predict("bsyn_lu", 1000, spherical=True) > model.predict("bsyn_lu", 1000)
+    # Fit to timings from a known law
+    rng = np.random.RandomState(42)
+    npoints = rng.randint(100, 100000, 200)
+    nbytes = rng.uniform(0, 5e7, 200)
+    spherical = rng.uniform(size=200) < 0.5
+    coeffs = np.array([-8.0, 0.9, 0.6, 1.2])
+    seconds = np.exp(cost.get_features(npoints, nbytes, spherical) @ coeffs)
+    records = [dict(program="bsyn_lu", npoints=int(n), nbytes=float(b), spherical=bool(s), seconds=t)
+               for n, b, s, t in zip(npoints, nbytes, spherical, seconds)]
+    model = cost.CostModel(records)
+    npt.assert_allclose(model.coeffs["bsyn_lu"][1:], coeffs[1:], atol=0.05)
+    assert model.scatter["bsyn_lu"] < 0.1
+    npt.assert_allclose(model.predict("bsyn_lu", npoints, nbytes, spherical), seconds, rtol=0.1)
+
+def test_rotate_timings(tmp_path, monkeypatch):
+    fname = str(tmp_path / "sub" / "timings.jsonl")
+    monkeypatch.setattr(cost, "_max_timings_bytes", 2000)
+    for i in range(100):
+        cost.record_timing("bsyn_lu", 1000+i, 0, False, 1.0, fname=fname)
+    assert os.path.getsize(fname) <= 2000
+    records = cost.read_timings(fname)
+    assert len(records) > 5
+    assert records[-1]["npoints"] == 1099
+    assert [r["npoints"] for r in records] == sorted(r["npoints"] for r in records)
@@ -0,0 +1,159 @@
+from __future__ import absolute_import, division, print_function
+import types
+import numpy as np
+import numpy.testing as npt
+import turbopy
+from turbopy import fitting
+
+def test_perturb_abundance():
+    args = [(12, 0.4), (6, 0.5)]
+    npt.assert_equal(fitting._perturb_abundance(args, 12, 0.1), [(12, 0.5), (6, 0.5)])
+    npt.assert_equal(fitting._perturb_abundance(args, 56, -0.1), [(12, 0.4), (6, 0.5), (56, -0.1)])
+    assert args == [(12, 0.4), (6, 0.5)]
+
+def test_perturb_missing_alpha():
+    # A missing alpha element is at the model's ALPHA/Fe, other elements at 0
+    assert fitting._perturb_abundance([(56, 0.2)], 12, 0.1, AM=0.4) == [(56, 0.2), (12, 0.5)]
+    npt.assert_allclose(fitting._perturb_abundance([(56, 0.2)], 25, 0.1, AM=0.4)[1], (25, 0.1))
+    assert fitting._perturb_abundance([(12, 0.0)], 12, 0.1, AM=0.4) == [(12, 0.1)]
+    assert turbopy.synth.get_XFe([(12, 0.0)], 20, 0.3) == 0.3
+
+def test_affects_continuum():
+    assert turbopy.synth.affects_continuum(26)
+    assert turbopy.synth.affects_continuum("Mg")
+    assert not turbopy.synth.affects_continuum("Ba")
+    assert not turbopy.synth.affects_continuum(3)
+
+def test_set_abundance():
+    args = [(12, 0.4), (6, 0.5)]
+    assert fitting._set_abundance(args, 12, -0.2) == [(12, -0.2), (6, 0.5)]
+    assert fitting._set_abundance(args, 56, 0.3) == [(12, 0.4), (6, 0.5), (56, 0.3)]
+    assert args == [(12, 0.4), (6, 0.5)]
+
+def _fake_line(wave, XFe, center):
+    """ A line whose depth grows smoothly with [X/Fe] """
+    depth = 0.8/(1 + np.exp(-2*XFe))
+    return -depth*np.exp(-0.5*((wave-center)/0.1)**2)
+
+def test_spline():
+    x = np.array([-1.0, -0.3, 0.0, 0.5, 1.0])
+    y = np.stack([x**3, 2*x + 1], axis=1)
+    M = fitting._spline_curvature(x, y)
+    npt.assert_allclose(M[[0, -1]], 0.0)
+    q = np.array([-1.0, -0.3, 0.2, 1.0])
+    out = fitting._spline_eval(x, y, M, q)
+    assert out.shape == (4, 2)
+    npt.assert_allclose(out[[0, 1, 3], 0], q[[0, 1, 3]]**3)
+    npt.assert_allclose(out[:, 1], 2*q + 1) # linear data is exact
+    # Two nodes is linear interpolation
+    npt.assert_allclose(fitting._spline_eval(x[:2], y[:2], fitting._spline_curvature(x[:2], y[:2]), q[:2]),
+                        y[:2])
+
+def test_abundance_emulator():
+    wave = np.linspace(6700, 6710, 1001)
+    Zs, base_XFe = [12, 56], np.array([0.2, 0.0])
+    centers = [6703.0, 6707.0]
+    offsets = np.array([-1.0, -0.5, 0.0, 0.5, 1.0])
+    nodes = base_XFe[:,None] + offsets
+    def truth(XFe):
+        return 1 + sum(_fake_line(wave, X, c) for X, c in zip(XFe, centers))
+    spectra = np.array([[truth(np.where(np.arange(2) == i, X, base_XFe)) for X in nodes[i]]
+                        for i in range(2)])
+    emulator = fitting.AbundanceEmulator(wave, truth(base_XFe), Zs, base_XFe, nodes, spectra)
+    # Exact at the nodes and the base
+    npt.assert_allclose(emulator(base_XFe), truth(base_XFe), atol=1e-12)
+    npt.assert_allclose(emulator([nodes[0,1], 0.0]), spectra[0,1], atol=1e-12)
+    # Many trials at once
+    rng = np.random.RandomState(1)
+    trials = base_XFe + rng.uniform(-1, 1, (200, 2))
+    out = emulator(trials)
+    assert out.shape == (200, len(wave))
+    expected = np.array([truth(XFe) for XFe in trials])
+    assert np.max(np.abs(out - expected)) < 0.01
+    # Held-out errors
+    holdout = base_XFe[:,None] + 0.5*(offsets[1:] + offsets[:-1])
+    held = np.array([[truth(np.where(np.arange(2) == i, X, base_XFe)) for X in holdout[i]]
+                     for i in range(2)])
+    emulator.set_holdout_errors(holdout, held)
+    assert emulator.errors.shape == (2,)
+    assert np.all(emulator.errors > 0) and np.all(emulator.errors < 0.01)
+    # The errors are at the lines of each element
+    assert abs(wave[np.argmax(emulator.error_spectrum[1])] - centers[1]) < 0.5
+
+def test_abundance_jacobian(monkeypatch):
+    """ The jacobian's jobs and differences, with fake syntheses """
+    wave = np.linspace(6700, 6710, 501)
+    calls = []
+    def fake_flux(XFe):
+        # Linear in Mg (at ALPHA/Fe if it is not given), quadratic in Ba
+        Ba = XFe.get(56, 0.0)
+        return 1 + 0.2*XFe.get(12, 0.4)*_fake_line(wave, 1.0, 6703.0) + \
+            (0.5*Ba + Ba**2)*_fake_line(wave, 1.0, 6707.0)
+    def fake_synth_star(wmin, wmax, dwl, base_args, jobs, star, prepared, nproc=None):
+        calls.append(jobs)
+        return [(wave, fake_flux(dict(args)), 2*fake_flux(dict(args))) for name, args in jobs]
+    monkeypatch.setattr(fitting, "_synth_star", fake_synth_star)
+    monkeypatch.setattr(fitting, "_prepare_star", lambda wmin, wmax, dwl, star:
+                        dict(atmosphere=types.SimpleNamespace(MH=0.0, AM=0.4)))
+    dMg = 0.2*_fake_line(wave, 1.0, 6703.0)
+    Ba_line = _fake_line(wave, 1.0, 6707.0)
+
+    # Forward differences, with a step of 0.2 for Ba
+    jacobian = turbopy.abundance_jacobian(6700, 6710, 0.02, [56, 0.3], params=["Mg", (56, 0.2)],
+                                          step=0.1, atmosphere="sun.mod")
+    assert [name for name, args in calls[-1]] == ["base", "d12p", "d56p"]
+    npt.assert_allclose(calls[-1][1][1], [(56, 0.3), (12, 0.5)])
+    npt.assert_allclose(calls[-1][2][1], [(56, 0.5)])
+    assert jacobian.shape == (2, len(wave))
+    npt.assert_allclose(jacobian[0], dMg, atol=1e-12)
+    # (f(0.5) - f(0.3))/0.2 of 0.5 Ba + Ba^2
+    npt.assert_allclose(jacobian[1], 1.3*Ba_line, atol=1e-12)
+
+    # Central differences are exact for the quadratic
+    w, base, jacobian = turbopy.abundance_jacobian(6700, 6710, 0.02, [56, 0.3],
+                                                   params=[12, (56, 0.2)], step=0.1, central=True,
+                                                   normalized=False, return_base=True,
+                                                   atmosphere="sun.mod")
+    assert [name for name, args in calls[-1]] == ["base", "d12p", "d12m", "d56p", "d56m"]
+    npt.assert_allclose(calls[-1][2][1], [(56, 0.3), (12, 0.3)])
+    npt.assert_allclose(calls[-1][4][1], [(56, 0.1)])
+    npt.assert_allclose(w, wave)
+    npt.assert_allclose(base, 2*fake_flux({56: 0.3}))
+    assert jacobian.shape == (2, len(wave))
+    npt.assert_allclose(jacobian[0], 2*dMg, atol=1e-12)
+    npt.assert_allclose(jacobian[1], 2*1.1*Ba_line, atol=1e-12)
+
+def test_build_abundance_emulator(monkeypatch):
+    """ The builder's jobs and bookkeeping, with fake syntheses """
+    wave = np.linspace(6700, 6710, 501)
+    calls = []
+    def fake_synth_star(wmin, wmax, dwl, base_args, jobs, star, prepared, nproc=None):
+        calls.append(jobs)
+        out = []
+        for name, args in jobs:
+            XFe = dict(args)
+            # Like Turbospectrum, Mg is at ALPHA/Fe if it is not given
+            flux = 1 + _fake_line(wave, XFe.get(12, 0.4), 6703.0) + _fake_line(wave, XFe.get(56, 0.0), 6707.0)
+            out.append((wave, flux, 2*flux))
+        return out
+    monkeypatch.setattr(fitting, "_synth_star", fake_synth_star)
+    monkeypatch.setattr(fitting, "_prepare_star", lambda wmin, wmax, dwl, star:
+                        dict(atmosphere=types.SimpleNamespace(MH=0.0, AM=0.4)))
+    emulator = turbopy.build_abundance_emulator(6700, 6710, 0.02, [56, 0.3],
+                                                params=["Mg", 56], atmosphere="sun.mod")
+    jobs = calls[0]
+    # The offset 0 nodes are the base synthesis
+    assert len(jobs) == 1 + 2*(4 + 4)
+    assert jobs[0] == ("base", [(56, 0.3)])
+    # Mg is not given, so it is at the model's ALPHA/Fe
+    assert jobs[1][0] == "node12_0"
+    npt.assert_allclose(jobs[1][1], [(56, 0.3), (12, -0.6)])
+    assert jobs[9][0] == "node56_0"
+    npt.assert_allclose(jobs[9][1], [(56, -0.7)])
+    npt.assert_allclose(emulator.base_XFe, [0.4, 0.3])
+    npt.assert_allclose(emulator.nodes[1], [-0.7, -0.2, 0.3, 0.8, 1.3])
+    assert emulator.errors.shape == (2,) and np.all(emulator.errors < 0.01)
+    base = 1 + _fake_line(wave, 0.4, 6703.0) + _fake_line(wave, 0.3, 6707.0)
+    npt.assert_allclose(emulator.base, base)
+    npt.assert_allclose(emulator.spectra[0,2], base)
+    npt.assert_allclose(emulator([0.4, 0.3]), base, atol=1e-12)
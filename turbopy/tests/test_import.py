@@ -0,0 +1,51 @@
+from __future__ import absolute_import, division, print_function
+import sys
+import json
+import subprocess
+
+# Budgets for importing turbopy and getting to run_synth in a fresh process.
+# Measured ~0.2 s and ~25 MB (mostly numpy); astropy alone adds ~0.35 s and ~30 MB.
+_import_time_budget = 0.5 # seconds
+_import_rss_budget = 40 # MB
+
+_measure = """
+import sys, time, json, resource
+def maxrss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1024**2 if sys.platform == "darwin" else rss/1024
+rss0 = maxrss()
+t0 = time.perf_counter()
+import turbopy
+bare = sorted(m for m in sys.modules if m.startswith("turbopy"))
+turbopy.run_synth
+dt = time.perf_counter() - t0
+print(json.dumps(dict(time=dt, rss=maxrss()-rss0, bare=bare,
+                      astropy="astropy" in sys.modules)))
+"""
+
+def _run_measure():
+    out = subprocess.check_output([sys.executable, "-c", _measure])
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+def test_import_is_lazy():
+    out = _run_measure()
+    assert out["bare"] == ["turbopy", "turbopy.version"], out["bare"]
+    assert not out["astropy"], "run_synth should not need astropy"
+
+def test_import_budget():
+    # Best of a few, to not fail on a slow filesystem cache
+    outs = [_run_measure() for i in range(3)]
+    dt = min(out["time"] for out in outs)
+    rss = min(out["rss"] for out in outs)
+    assert dt < _import_time_budget, f"import took {dt:.3f} s > {_import_time_budget} s"
+    assert rss < _import_rss_budget, f"import used {rss:.1f} MB > {_import_rss_budget} MB"
+
+def test_lazy_attributes():
+    import turbopy
+    assert turbopy.TSLineList is turbopy.linelists.TSLineList
+    assert "run_synth" in dir(turbopy)
+    try:
+        turbopy.not_a_thing
+        raise AssertionError("Should have raised")
+    except AttributeError:
+        pass
@@ -17,6 +17,18 @@ def test_linelist_write():
     tab = turbopy.linelists.read_vald_long(os.path.join(data_path, "BertrandPlez.002060"),
                                            outfname=os.path.join(data_path, "converted_BertrandPlez.002060"))
 
+def test_linelist_empty(tmp_path):
+    fname = str(tmp_path / "empty.vald")
+    with open(os.path.join(data_path, "BertrandPlez.002060")) as fp:
+        header = [fp.readline() for i in range(3)]
+    with open(fname, "w") as fp:
+        fp.write("".join(header) + "* oscillator strengths were NOT scaled\n")
+    outfname = str(tmp_path / "empty.list")
+    tab = turbopy.linelists.read_vald_long(fname, outfname=outfname)
+    assert len(tab) == 0
+    assert "wave" in tab.colnames
+    assert os.path.getsize(outfname) == 0
+
 def test_get_levels():
     # Taken from Bertrand's vald-6700-6720.list
     test_data = [
@@ -41,3 +53,114 @@ def test_get_levels():
     print(outdata1)
     print(outdata2)
     npt.assert_equal(outdata2, outdata1)
+    
+    # The batched version, with repeats to exercise the memoization
+    levlo, levup = turbopy.linelists._get_levels_batch([x[2] for x in test_data]*3,
+                                                       [x[3] for x in test_data]*3)
+    npt.assert_equal(list(zip(levlo, levup)), outdata1*3)
+
+def test_read_write_blocks(tmp_path):
+    fname = os.path.join(data_path, "vald-6700-6720.list")
+    blocks = turbopy.linelists.read_turbospectrum_blocks(fname)
+    assert blocks[0][:3] == ("3.000", 1, "'Li I   '")
+    outfname = str(tmp_path / "copy.list")
+    N = turbopy.linelists.write_turbospectrum_blocks(blocks, outfname)
+    assert N == sum(len(block[4]) for block in blocks)
+    blocks2 = turbopy.linelists.read_turbospectrum_blocks(outfname)
+    assert len(blocks2) == len(blocks)
+    for block, block2 in zip(blocks, blocks2):
+        npt.assert_equal(block2[3], block[3])
+        npt.assert_equal(block2[4], block[4])
+
+def test_trimmed_linelist(tmp_path, monkeypatch):
+    monkeypatch.setenv("TURBOPY_CACHE", str(tmp_path))
+    fname = os.path.join(data_path, "vald-6700-6720.list")
+    trimmed = turbopy.linelists.get_trimmed_linelist(fname, 6707.0, 6708.0, margin=0.5)
+    assert os.path.dirname(trimmed) == str(tmp_path)
+    waves = np.concatenate([block[3] for block in turbopy.linelists.read_turbospectrum_blocks(trimmed)])
+    assert len(waves) > 0
+    assert np.all((waves >= 6706.5) & (waves <= 6708.5))
+    # Cached
+    assert turbopy.linelists.get_trimmed_linelist(fname, 6707.0, 6708.0, margin=0.5) == trimmed
+    assert turbopy.linelists.get_trimmed_linelist(fname, 5000.0, 5001.0) is None
+
+def test_combined_linelist(tmp_path, monkeypatch):
+    monkeypatch.setenv("TURBOPY_CACHE", str(tmp_path))
+    fname1 = os.path.join(data_path, "vald-6700-6720.list")
+    fname2 = os.path.join(data_path, "converted_BertrandPlez.002060")
+    blocks1 = turbopy.linelists.read_turbospectrum_blocks(fname1)
+    N1 = sum(len(block[4]) for block in blocks1)
+
+    # The same source twice is deduplicated
+    ll = turbopy.TSLineList.combine(turbopy.TSLineList(fname1), turbopy.TSLineList(fname1))
+    blocks = turbopy.linelists.read_turbospectrum_blocks(ll.get_fname())
+    assert sum(len(block[4]) for block in blocks) == N1
+
+    # Without a margin, a single source is used as it is and nothing is trimmed
+    assert turbopy.TSLineList(fname1).get_fname(6705.0, 6710.0) == fname1
+    blocks = turbopy.linelists.read_turbospectrum_blocks(
+        turbopy.TSLineList([fname1, fname2]).get_fname(6705.0, 6710.0))
+    assert sum(len(block[4]) for block in blocks) > N1
+    assert turbopy.TSLineList.combine(turbopy.TSLineList(fname1, margin=1.),
+                                      turbopy.TSLineList(fname2)).margin is None
+
+    ll = turbopy.TSLineList([fname1, fname2], margin=0.)
+    combined = ll.get_fname(6705.0, 6710.0)
+    assert ll.get_fname(6705.0, 6710.0) == combined
+    blocks = turbopy.linelists.read_turbospectrum_blocks(combined)
+    keys = [(float(block[0]), block[1]) for block in blocks]
+    assert keys == sorted(set(keys))
+    for block in blocks:
+        assert np.all(np.diff(block[3]) >= 0)
+        assert np.all((block[3] >= 6705.0) & (block[3] <= 6710.0))
+
+def test_split_linelist(tmp_path, monkeypatch):
+    monkeypatch.setenv("TURBOPY_CACHE", str(tmp_path))
+    fname1 = os.path.join(data_path, "vald-6700-6720.list")
+    fname2 = os.path.join(data_path, "converted_BertrandPlez.002060")
+    windows = [(6701.0, 6702.0), (6707.0, 6708.0), (6715.0, 6716.5)]
+    reads = []
+    read_turbospectrum_blocks = turbopy.linelists.read_turbospectrum_blocks
+    def counting_read(fname):
+        reads.append(fname)
+        return read_turbospectrum_blocks(fname)
+    monkeypatch.setattr(turbopy.linelists, "read_turbospectrum_blocks", counting_read)
+    # Each window has the same lines as trimming the source to it
+    split = turbopy.linelists.split_linelist(fname1, windows, margin=0.5)
+    assert reads == [fname1]
+    for (wmin, wmax), this_fname in zip(windows, split):
+        trimmed = turbopy.linelists.get_trimmed_linelist(fname1, wmin, wmax, margin=0.5)
+        blocks, expected = read_turbospectrum_blocks(this_fname), read_turbospectrum_blocks(trimmed)
+        assert [(b[0], b[1], b[4]) for b in blocks] == [(b[0], b[1], b[4]) for b in expected]
+    # Cached
+    del reads[:]
+    assert turbopy.linelists.split_linelist(fname1, windows, margin=0.5) == split
+    assert reads == []
+    # Several sources: read once each, for the full extent
+    ll = turbopy.TSLineList([fname1, fname2], margin=0.5)
+    fnames = ll.get_fnames(windows)
+    assert len(fnames) == 3
+    assert sorted(reads[:2]) == sorted([fname1, fname2])
+    assert fname1 not in reads[2:] and fname2 not in reads[2:]
+    for (wmin, wmax), this_fname in zip(windows, fnames):
+        waves = np.concatenate([b[3] for b in read_turbospectrum_blocks(this_fname)])
+        assert np.all((waves >= wmin - 0.5) & (waves <= wmax + 0.5))
+    # Without a margin every window gets all lines
+    assert turbopy.TSLineList(fname1).get_fnames(windows) == [fname1]*3
+
+def test_estimate_bytes(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("TURBOPY_CACHE", str(cache_dir))
+    fname = os.path.join(data_path, "vald-6700-6720.list")
+    size = os.path.getsize(fname)
+    # Untrimmed: the source itself
+    assert turbopy.TSLineList(fname).estimate_bytes(6705.0, 6706.0) == size
+    # Trimmed: about the fraction of the 6700-6720 range, without reading or caching anything
+    estimate = turbopy.TSLineList(fname, margin=0.5).estimate_bytes(6705.0, 6706.0)
+    assert 0.03*size < estimate < 0.2*size
+    assert turbopy.linelists.estimate_trimmed_bytes(fname, 5000.0, 5001.0) == 0
+    assert not cache_dir.exists()
+    # Once the trimmed file exists, its size
+    trimmed = turbopy.linelists.get_trimmed_linelist(fname, 6705.0, 6706.0, margin=0.5)
+    assert turbopy.linelists.estimate_trimmed_bytes(fname, 6705.0, 6706.0, margin=0.5) == \
+        os.path.getsize(trimmed)
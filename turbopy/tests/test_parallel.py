@@ -0,0 +1,37 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import numpy.testing as npt
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from turbopy import parallel
+
+pytest.importorskip("multiprocessing.shared_memory")
+
+def _write_job(name, capacities, i):
+    shared = parallel.SharedSpectra.attach(name, capacities)
+    try:
+        wave = np.arange(i+3, dtype=float)
+        return shared.write(i, wave, 2*wave, 3*wave)
+    finally:
+        shared.close()
+
+def test_map_jobs():
+    out = parallel.map_jobs(lambda x, y: x*y, [(i, 2) for i in range(20)], nproc=4)
+    assert out == [2*i for i in range(20)]
+
+def test_shared_spectra():
+    capacities = [5, 4, 10]
+    with parallel.SharedSpectra(capacities) as shared:
+        with ProcessPoolExecutor(2) as pool:
+            ns = list(pool.map(_write_job, [shared.name]*3, [capacities]*3, range(3)))
+        for i, n in enumerate(ns):
+            shared.set_length(i, n)
+        assert len(shared) == 3
+        for i, (wave, norm, flux) in enumerate(shared):
+            npt.assert_equal(wave, np.arange(i+3))
+            npt.assert_equal(flux, 3*wave)
+        # Views, not copies
+        assert shared[1][0].base is not None
+    with parallel.SharedSpectra([2]) as shared:
+        with pytest.raises(ValueError):
+            shared.write(0, np.zeros(3), np.zeros(3), np.zeros(3))
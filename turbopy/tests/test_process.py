@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, print_function
+import os
+import stat
+import builtins
+import pytest
+import turbopy
+from turbopy import process
+
+def _make_program(tmp_path, name, body):
+    fname = str(tmp_path / name)
+    with open(fname, "w") as fp:
+        fp.write("#!/bin/sh\n" + body + "\n")
+    os.chmod(fname, os.stat(fname).st_mode | stat.S_IEXEC)
+    parfilename = str(tmp_path / "test.par")
+    with open(parfilename, "w") as fp:
+        fp.write("'LAMBDA_MIN:'  '6700.000'\n")
+    return fname, parfilename
+
+@pytest.fixture
+def limits(tmp_path):
+    old = process.get_limits()
+    process.set_limits(lockdir=str(tmp_path), max_procs=2, retries=1)
+    yield
+    process._limits.update(old)
+
+def test_run_program_ok(tmp_path, limits):
+    program, parfilename = _make_program(tmp_path, "ok_lu", "cat > out.txt; echo done")
+    seconds = process.run_program(program, str(tmp_path), parfilename, outfiles=[str(tmp_path / "out.txt")])
+    assert 0 < seconds < 10
+    with open(tmp_path / "out.txt") as fp:
+        assert fp.read().startswith("'LAMBDA_MIN:'")
+    with open(tmp_path / "ok_lu.log") as fp:
+        assert fp.read().strip() == "done"
+
+def test_run_program_returncode(tmp_path, limits):
+    program, parfilename = _make_program(tmp_path, "bad_lu", "echo $$ >> tries.txt; echo oops; exit 3")
+    with pytest.raises(turbopy.TurbospectrumError) as e:
+        process.run_program(program, str(tmp_path), parfilename)
+    assert e.value.reason == "returncode"
+    assert e.value.returncode == 3
+    assert e.value.attempts == 2
+    assert "oops" in e.value.output
+    with open(tmp_path / "tries.txt") as fp:
+        assert len(fp.readlines()) == 2
+
+def test_run_program_output(tmp_path, limits):
+    program, parfilename = _make_program(tmp_path, "lazy_lu", "cat > /dev/null")
+    with pytest.raises(turbopy.TurbospectrumError) as e:
+        process.run_program(program, str(tmp_path), parfilename, outfiles=[str(tmp_path / "out.txt")])
+    assert e.value.reason == "output"
+
+def test_run_program_timeout(tmp_path, limits):
+    program, parfilename = _make_program(tmp_path, "slow_lu", "exec sleep 10")
+    process.set_limits(timeout={"slow_lu": 0.2}, retries=0)
+    with pytest.raises(turbopy.TurbospectrumError) as e:
+        process.run_program(program, str(tmp_path), parfilename)
+    assert e.value.reason == "timeout"
+    assert e.value.attempts == 1
+
+def test_set_limits():
+    with pytest.raises(ValueError):
+        process.set_limits(not_a_limit=1)
+
+def test_run_program_rlimits(tmp_path, limits):
+    """ The limits are in place when the program starts """
+    pytest.importorskip("resource")
+    process.set_limits(max_memory=2*1024**3, max_cpu_time=100)
+    program, parfilename = _make_program(tmp_path, "limits_lu",
+                                         "cat > /dev/null; ulimit -v > out.txt; ulimit -t >> out.txt")
+    process.run_program(program, str(tmp_path), parfilename, outfiles=[str(tmp_path / "out.txt")])
+    with open(tmp_path / "out.txt") as fp:
+        assert fp.read().split() == [str(2*1024**2), "100"]
+    # The shell that sets the limits does not hide a missing program
+    with pytest.raises(turbopy.TurbospectrumError) as e:
+        process.run_program(str(tmp_path / "missing_lu"), str(tmp_path), parfilename)
+    assert e.value.reason == "launch"
+
+def test_run_program_readonly_slots(tmp_path, limits, monkeypatch):
+    """ Slot files that another user created, and this one cannot write, still work """
+    for i in range(2):
+        fname = tmp_path / f"turbopy-slot-{i}.lock"
+        fname.touch()
+        fname.chmod(0o444)
+    # Also when running as root, who can write them anyway
+    def is_slot(fname):
+        return os.path.basename(str(fname)).startswith("turbopy-slot-")
+    os_open, builtins_open = os.open, builtins.open
+    def os_open_as_other_user(fname, flags, *args):
+        if is_slot(fname) and flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC):
+            raise PermissionError(13, "Permission denied", fname)
+        return os_open(fname, flags, *args)
+    def open_as_other_user(fname, mode="r", *args, **kwargs):
+        if is_slot(fname) and set(mode) & set("wax+"):
+            raise PermissionError(13, "Permission denied", fname)
+        return builtins_open(fname, mode, *args, **kwargs)
+    monkeypatch.setattr(os, "open", os_open_as_other_user)
+    monkeypatch.setattr(builtins, "open", open_as_other_user)
+    program, parfilename = _make_program(tmp_path, "ok_lu", "cat > out.txt")
+    process.run_program(program, str(tmp_path), parfilename, outfiles=[str(tmp_path / "out.txt")])
+
+def test_run_program_slot_error(tmp_path, limits):
+    process.set_limits(lockdir=str(tmp_path / "missing"))
+    program, parfilename = _make_program(tmp_path, "ok_lu", "cat > out.txt")
+    with pytest.raises(turbopy.TurbospectrumError) as e:
+        process.run_program(program, str(tmp_path), parfilename)
+    assert e.value.reason == "launch"
+    assert "lockdir" in str(e.value)
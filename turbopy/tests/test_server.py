@@ -0,0 +1,97 @@
+from __future__ import absolute_import, division, print_function
+import os
+import time
+import threading
+import numpy as np
+import numpy.testing as npt
+import pytest
+import turbopy
+
+shared_memory = pytest.importorskip("multiprocessing.shared_memory")
+from turbopy import server
+
+@pytest.fixture
+def fake_server(tmp_path, monkeypatch):
+    """ A server whose syntheses are fake, so Turbospectrum is not needed """
+    calls = []
+    def fake_run_synth(wmin, wmax, dwl, *args, **kwargs):
+        calls.append((wmin, wmax, dwl) + args)
+        if wmin > wmax: raise ValueError("wmin > wmax")
+        time.sleep(0.2)
+        wave = np.arange(wmin, wmax, dwl)
+        return wave, np.ones_like(wave), len(args)*np.ones_like(wave)
+    monkeypatch.setattr(turbopy.synth, "run_synth", fake_run_synth)
+    address = str(tmp_path / "server.sock")
+    srv = server.SynthServer(address, nproc=2, workdir=str(tmp_path / "work")).start()
+    yield srv, calls
+    srv.shutdown()
+
+def test_server_run_synth(fake_server):
+    srv, calls = fake_server
+    wave, norm, flux = server.run_synth(6700, 6701, 0.1, [12, 0.4], address=srv.address)
+    npt.assert_almost_equal(wave, np.arange(6700, 6701, 0.1))
+    npt.assert_equal(flux, 1.)
+    with pytest.raises(ValueError):
+        server.run_synth(6701, 6700, 0.1, address=srv.address)
+
+def test_server_dedup(fake_server):
+    srv, calls = fake_server
+    results = [None]*4
+    def client(i):
+        results[i] = server.run_synth(6700, 6701, 0.1, [12, 0.4], address=srv.address)
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert len(calls) == 1
+    for result in results:
+        npt.assert_equal(result[0], results[0][0])
+    stats = server.get_stats(srv.address)
+    assert stats["nrequests"] == 4
+    assert stats["nsynth"] == 1
+
+def test_server_priority(fake_server):
+    srv, calls = fake_server
+    # Fill both workers, then queue a low and a high priority request
+    for i in range(2):
+        srv.submit((6700, 6701, 0.1, (i, 0.0)), {})
+    time.sleep(0.05)
+    low = srv.submit((6700, 6701, 0.1, (3, 0.0)), {}, priority=0)
+    high = srv.submit((6700, 6701, 0.1, (4, 0.0)), {}, priority=10)
+    high.get(); low.get()
+    assert calls[2][3] == (4, 0.0)
+    assert calls[3][3] == (3, 0.0)
+
+def test_server_socket(fake_server, tmp_path):
+    srv, calls = fake_server
+    assert oct(os.stat(srv.address).st_mode & 0o777) == oct(0o600)
+    # A running server keeps its socket
+    with pytest.raises(RuntimeError):
+        server.SynthServer(srv.address, nproc=1, workdir=str(tmp_path / "work2")).start()
+    server.run_synth(6700, 6701, 0.1, address=srv.address)
+    # A stale socket file is replaced
+    stale = server.SynthServer(str(tmp_path / "stale.sock"), nproc=1, workdir=str(tmp_path / "work3"))
+    open(stale.address, "w").close()
+    stale.start()
+    stale.shutdown()
+
+def test_server_shared_opacity(fake_server, monkeypatch):
+    """ Requests sharing an opacity wait for its babsma_lu only, not each other's bsyn_lu """
+    srv, calls = fake_server
+    babsma_calls = []
+    def fake_run_shared_babsma(twd, args, kwargs, modelopac=None):
+        babsma_calls.append(modelopac)
+        time.sleep(0.1)
+        open(modelopac, "w").close()
+        return modelopac
+    monkeypatch.setattr(turbopy.synth, "_run_shared_babsma", fake_run_shared_babsma)
+    atmo = turbopy.MARCSModel.load(os.path.join(turbopy.__path__[0], "data", "sun.mod"))
+    atmo.MH, atmo.AM = 0.0, 0.0
+    # Ba does not change the continuum, so both share one opacity
+    futures = [srv.submit((6700, 6701, 0.1, (56, BaFe)), dict(atmosphere=atmo, vt=1.0))
+               for BaFe in [0.0, 0.5]]
+    t0 = time.time()
+    for future in futures:
+        assert future.get()[0] == "ok"
+    assert len(babsma_calls) == 1
+    # 0.1 s babsma_lu, then both 0.2 s fake syntheses at once
+    assert time.time() - t0 < 0.45
@@ -78,3 +78,51 @@ def test_synth_linelist():
     npt.assert_almost_equal(wave1, wave2)
     npt.assert_almost_equal(norm1, norm2)
     npt.assert_almost_equal(flux1, flux2)
+
+def test_merge_windows():
+    windows = turbopy.synth.merge_windows([6707.8, (6700.05, 6701.0), 6708.5, 6715.0],
+                                          0.01, halfwidth=0.5)
+    npt.assert_almost_equal(windows, [(6700.05, 6701.0), (6707.3, 6709.0), (6714.5, 6715.5)])
+
+def test_windowed_spectrum():
+    spectra = [(np.arange(3.), np.ones(3), 2*np.ones(3)),
+               (np.arange(5.,7.), np.ones(2), 2*np.ones(2))]
+    spec = turbopy.WindowedSpectrum([(0., 2.), (5., 6.)], spectra)
+    assert len(spec) == 2
+    assert spec.npoints == 5
+    npt.assert_equal(spec.wave, [0., 1., 2., 5., 6.])
+    npt.assert_equal(spec.flux, 2*np.ones(5))
+
+def test_write_script_intensity(tmp_path):
+    scriptfilename = str(tmp_path / "bsyn.par")
+    for intensity, mode in [(False, "'Flux'"), (True, "'Intensity'")]:
+        turbopy.synth._write_script(scriptfilename, 6700, 6720, 0.01, 0.5,
+                                    "atm.mod", True, "mopac", 0.0, 0.0, {26: 7.45},
+                                    None, False, "bsyn.out", {}, ["ll"],
+                                    bsyn=True, intensity=intensity)
+        with open(scriptfilename) as fp:
+            lines = fp.readlines()
+        assert lines[3].split()[-1] == mode
+        assert lines[4].split()[-1] == "'0.500'"
+
+def test_adaptive_segments():
+    segments = turbopy.synth.adaptive_segments(6700, 6720, 0.01, 0.1, [6705.0, 6705.2, 6718.0], halfwidth=0.5)
+    npt.assert_almost_equal(segments, [(6700.0, 6704.5, 0.1), (6704.5, 6705.7, 0.01),
+                                       (6705.7, 6717.5, 0.1), (6717.5, 6718.5, 0.01),
+                                       (6718.5, 6720.0, 0.1)])
+    # Short gaps are sampled finely
+    segments = turbopy.synth.adaptive_segments(6700, 6720, 0.01, 0.1, [6700.2, 6701.4], halfwidth=0.5)
+    npt.assert_almost_equal(segments, [(6700.0, 6701.9, 0.01), (6701.9, 6720.0, 0.1)])
+    # No lines: coarse everywhere, split to respect _lpoint_max
+    segments = turbopy.synth.adaptive_segments(3000, 10000, 0.01, 0.05, [])
+    assert segments[0][0] == 3000 and segments[-1][1] == 10000
+    for wlo, whi, step in segments:
+        assert step == 0.05
+        assert (whi - wlo)/step <= turbopy.synth._lpoint_max
+
+def test_merge_segments():
+    spectra = [(np.array([0., 1., 2.]), np.ones(3), np.ones(3)),
+               (np.array([2., 2.5, 3.]), 2*np.ones(3), 2*np.ones(3))]
+    wave, norm, flux = turbopy.synth._merge_segments(spectra)
+    npt.assert_equal(wave, [0., 1., 2., 2.5, 3.])
+    npt.assert_equal(norm, [1., 1., 1., 2., 2.])
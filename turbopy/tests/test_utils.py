@@ -37,3 +37,27 @@ def test_make_tspecies():
         Zs = [utils.elem_to_Z(el) for el in out[0]]
         new_tspecies = utils.make_tspecies(Zs, out[2]).strip()
         npt.assert_equal(tspecies, new_tspecies)
+
+def test_identify_species():
+    """
+    The array version should give the same answers as identify_fullspecstr and make_tspecies
+    """
+    specstrs = [x[0] for x in things_to_test]*3
+    fullspecstrs = [x[1] for x in things_to_test]*3
+    Zs, ions, isos, nelems, tspecies = utils.identify_species(specstrs, fullspecstrs)
+    for i, (specstr, fullspecstr, elems, ion, iso, ts) in enumerate(things_to_test*3):
+        npt.assert_equal(Zs[i,:nelems[i]], [utils.elem_to_Z(el) for el in elems])
+        npt.assert_equal(ions[i], ion)
+        npt.assert_equal(isos[i,:nelems[i]], iso)
+        npt.assert_equal(tspecies[i].strip(), ts)
+
+def test_element_lookups():
+    npt.assert_equal(utils.get_solar(26), utils.get_solar("Fe"))
+    npt.assert_equal(utils.get_solar(np.array([26, 12])), [utils.get_solar(26), utils.get_solar(12)])
+    npt.assert_equal(utils.get_ionp1(["Fe", "Mg"]), [utils.get_ionp1(26), utils.get_ionp1(12)])
+    npt.assert_equal(utils.get_ionp2(np.array([[20, 56]])), [[utils.get_ionp2(20), utils.get_ionp2(56)]])
+    try:
+        utils.elem_to_Z("Xx")
+        raise AssertionError("Should have raised")
+    except ValueError:
+        pass
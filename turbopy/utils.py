@@ -2,8 +2,8 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import re
+import functools
 import numpy as np
-from astropy.table import Table
 
 _all_elems = ["H","He","Li","Be","B","C","N","O","F","Ne","Na","Mg","Al","Si","P","S","Cl","Ar",
               "K","Ca","Sc","Ti","V","Cr","Mn","Fe","Co","Ni","Cu","Zn","Ga","Ge","As","Se","Br","Kr",
@@ -54,30 +54,37 @@ _ionp2 = [
      99.99, 12.00
 ]
 
+_elem_to_Z = {elem: Z for Z, elem in enumerate(_all_elems, 1)}
+_sunabund_arr = np.array(_sunabund)
+_ionp1_arr = np.array(_ionp1)
+_ionp2_arr = np.array(_ionp2)
+
 def Z_to_elem(Z):
     return _all_elems[Z-1]
 def elem_to_Z(elem):
     try:
-        ix = _all_elems.index(elem)
-    except ValueError as e:
+        return _elem_to_Z[elem]
+    except KeyError as e:
         raise ValueError(f"'{elem}' is not a valid element")
-    return ix + 1
+def _lookup(table, table_arr, Z_or_elem):
+    """ Scalar lookup from the list, or a NumPy gather for arrays of Z or elements """
+    if isinstance(Z_or_elem, str): return table[elem_to_Z(Z_or_elem)-1]
+    if np.ndim(Z_or_elem) == 0: return table[int(Z_or_elem)-1]
+    Zs = np.asarray(Z_or_elem)
+    if Zs.dtype.kind in "US": Zs = np.array([elem_to_Z(el) for el in Zs.ravel()]).reshape(Zs.shape)
+    return table_arr[Zs.astype(int)-1]
 def get_solar(Z_or_elem):
-    if isinstance(Z_or_elem, str): Z_or_elem = elem_to_Z(Z_or_elem)
-    return _sunabund[Z_or_elem-1]
+    return _lookup(_sunabund, _sunabund_arr, Z_or_elem)
 def get_ionp1(Z_or_elem):
-    if isinstance(Z_or_elem, str): Z_or_elem = elem_to_Z(Z_or_elem)
-    return _ionp1[Z_or_elem-1]
+    return _lookup(_ionp1, _ionp1_arr, Z_or_elem)
 def get_ionp2(Z_or_elem):
-    if isinstance(Z_or_elem, str): Z_or_elem = elem_to_Z(Z_or_elem)
-    return _ionp2[Z_or_elem-1]
+    return _lookup(_ionp2, _ionp2_arr, Z_or_elem)
 
 def identify_specstr(specstr):
     """ Figure out what is the species number, isotope, etc for """
     if specstr.startswith("'"): specstr = specstr[1:-1]
     species, ion = specstr.split()
-    upperspecies = species.upper()
-    ix_capital, = np.where(np.array([x==y for x,y in zip(species, upperspecies)]))
+    ix_capital = [i for i, x in enumerate(species) if x == x.upper()]
     Nelem = len(ix_capital)
     ix = list(ix_capital) + [len(species)]
     elems = [species[ix[i]:ix[i+1]] for i in range(Nelem)]
@@ -114,3 +121,41 @@ def make_tspecies(Zs, isos=None):
             isos[0], isos[1] = isos[1], isos[0]
         return f"{Zs[0]:>2}{Zs[1]:02}.{isos[0]:03}{isos[1]:03}"
     raise ValueError("make_tspecies only works up to to-atom molecules")
+
+@functools.lru_cache(maxsize=None)
+def _identify_species(specstr, fullspecstr):
+    """ Memoized identify_fullspecstr + elem_to_Z + make_tspecies for one species """
+    elems, ion, isos = identify_fullspecstr(specstr, fullspecstr)
+    Zs = [elem_to_Z(el) for el in elems]
+    # make_tspecies reorders its inputs in place
+    tspecies = make_tspecies(list(Zs), list(isos))
+    return tuple(Zs), ion, tuple(isos), tspecies
+
+def identify_species(specstrs, fullspecstrs):
+    """
+    Array version of identify_fullspecstr, elem_to_Z and make_tspecies.
+    Each unique (specstr, fullspecstr) pair is only worked out once;
+    real linelists have only a few hundred of them.
+
+    Returns Zs (N,2), ions (N,), isos (N,2), nelems (N,), tspecies (N,)
+    with Zs and isos in the order of the species string, 0 for atoms' second element
+    """
+    specstrs = np.asarray(specstrs, dtype=str)
+    fullspecstrs = np.asarray(fullspecstrs, dtype=str)
+    assert specstrs.shape == fullspecstrs.shape
+    pairs = np.char.add(np.char.add(specstrs, "|"), fullspecstrs)
+    upairs, ix, inverse = np.unique(pairs, return_index=True, return_inverse=True)
+    N = len(upairs)
+    uZs, uisos = np.zeros((N,2), dtype=int), np.zeros((N,2), dtype=int)
+    uions, unelems = np.zeros(N, dtype=int), np.zeros(N, dtype=int)
+    utspecies = []
+    for i, j in enumerate(ix):
+        Zs, ion, isos, tspecies = _identify_species(str(specstrs[j]), str(fullspecstrs[j]))
+        uZs[i,:len(Zs)] = Zs
+        uisos[i,:len(isos)] = isos
+        uions[i] = ion
+        unelems[i] = len(Zs)
+        utspecies.append(tspecies)
+    utspecies = np.array(utspecies, dtype=str)
+    inverse = inverse.ravel()
+    return uZs[inverse], uions[inverse], uisos[inverse], unelems[inverse], utspecies[inverse]
@@ -58,5 +58,5 @@ MICRO = _version_micro
 VERSION = __version__
 PACKAGE_DATA = {'turbopy': [pjoin('data', '*')]}
 REQUIRES = ["numpy","astropy"]
-PYTHON_REQUIRES = ">= 3.5"
+PYTHON_REQUIRES = ">= 3.7"
 